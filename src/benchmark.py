@@ -0,0 +1,581 @@
+# Bruno Bastos 93302
+# Leandro Silva 93446
+
+import argparse
+import gzip
+import itertools
+import json
+import logging
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+from tabulate import tabulate
+from tokenizer import Review, Tokenizer
+from indexer import Indexer
+from query import BM25, VSM, Query
+from utils import get_directory_size, levenshtein, levenshtein_bit_parallel, levenshtein_dp
+
+
+SYLLABLES = ["ba", "ce", "di", "fo", "gu", "ka", "le", "mi", "no", "pu",
+             "ra", "se", "ti", "vo", "zu", "an", "er", "is", "on", "ul"]
+
+# the most frequent words of a review, which end up being the head of the Zipfian distribution
+COMMON_WORDS = ["the", "and", "i", "it", "to", "a", "is", "this", "of", "game",
+                "great", "for", "music", "you", "love", "album", "fun", "good", "play", "song"]
+
+# tokens that exercise the different steps of the tokenizer
+NOISY_TOKENS = ["1990", "3.5", "10,000", "don't", "it's", "<br", "/>", "!!", "5/5", "A+",
+                "--", "(great)", "\"best\"", "co-op", "e-mail", "café", "10/10"]
+
+COLUMNS = ["marketplace", "customer_id", "review_id", "product_id", "product_parent",
+           "product_title", "product_category", "star_rating", "helpful_votes", "total_votes",
+           "vine", "verified_purchase", "review_headline", "review_body", "review_date"]
+
+
+def synthetic_vocabulary(size, seed=0):
+    """Return a list of `size` distinct words, the most common ones first."""
+
+    rng = random.Random(seed)
+    vocabulary = list(COMMON_WORDS[:size])
+    words = set(vocabulary)
+    while len(vocabulary) < size:
+        word = "".join(rng.choices(SYLLABLES, k=rng.randint(2, 5)))
+        if word not in words:
+            words.add(word)
+            vocabulary.append(word)
+    return vocabulary
+
+
+def synthetic_reviews(n_docs, seed=0, vocabulary_size=20_000, zipf_s=1.1, noise=0.05):
+    """
+    Yield the lines of a TSV review dataset, starting by the header.
+    The words of the reviews follow a Zipfian distribution over a synthetic vocabulary.
+
+    @param n_docs: the number of reviews
+    @param seed: the seed that makes the dataset deterministic
+    @param vocabulary_size: the number of distinct words
+    @param zipf_s: the exponent of the Zipfian distribution
+    @param noise: the probability of a token being capitalized, punctuated or a noisy token
+    """
+    rng = random.Random(seed)
+    vocabulary = synthetic_vocabulary(vocabulary_size, seed)
+    cum_weights = list(itertools.accumulate(1 / rank**zipf_s for rank in range(1, vocabulary_size + 1)))
+
+    def text(length):
+        words = rng.choices(vocabulary, cum_weights=cum_weights, k=length)
+        for i in range(length):
+            if rng.random() < noise:
+                choice = rng.random()
+                if choice < 0.4:
+                    words[i] = words[i].capitalize()
+                elif choice < 0.7:
+                    words[i] += rng.choice(".,!?;:")
+                else:
+                    words[i] = rng.choice(NOISY_TOKENS)
+        return " ".join(words)
+
+    yield "\t".join(COLUMNS) + "\n"
+    for i in range(n_docs):
+        doc = ["US", str(rng.randint(10**7, 10**8)), "", f"B{rng.getrandbits(36):09X}",
+               str(rng.randint(10**8, 10**9)), "", "Digital_Music_Purchase", str(rng.randint(1, 5)),
+               str(rng.randint(0, 10)), str(rng.randint(0, 20)), "N", rng.choice("YN"),
+               "", "", f"20{rng.randint(0, 15):02d}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}"]
+        doc[Review.ID] = f"R{i:07d}{rng.getrandbits(20):05X}"
+        doc[Review.TITLE] = text(rng.randint(1, 6))
+        doc[Review.HEADLINE] = text(rng.randint(1, 10))
+        doc[Review.BODY] = text(min(int(rng.lognormvariate(3.5, 0.9)) + 1, 1000))
+        yield "\t".join(doc) + "\n"
+
+
+def percentile(values, p):
+    """Return the `p` percentile of a list of values, interpolating between the closest ranks."""
+
+    values = sorted(values)
+    k = (len(values) - 1) * p / 100
+    low, high = math.floor(k), math.ceil(k)
+    return values[low] + (values[high] - values[low]) * (k - low)
+
+
+def write_dataset(filename, docs, seed=0):
+    """Write a synthetic dataset with `docs` reviews to `filename`, zipped if it ends with ".gz"."""
+
+    with (gzip.open(filename, "wt") if filename.endswith(".gz") else open(filename, "w")) as f:
+        f.writelines(synthetic_reviews(docs, seed))
+
+
+def create_indexer(directory, **options):
+    """
+    Create an indexer whose index is written in `directory`.
+
+    @param directory: the directory where the index is written
+    @param options: the indexer, tokenizer and ranking options, as in a config file
+    """
+    ranking = BM25(**options) if options.get("name", "BM25") == "BM25" else VSM(**options)
+    return Indexer(tokenizer=Tokenizer(**options), ranking=ranking,
+                   merge_dir=os.path.join(directory, "indexer/"), **options)
+
+
+def build_index(directory, docs, seed=0, **options):
+    """
+    Index a synthetic dataset in `directory` and return the directory of the index.
+
+    @param directory: the directory where the dataset and the index are written
+    @param docs: the number of synthetic reviews
+    @param seed: the seed of the synthetic reviews
+    @param options: the indexer, tokenizer and ranking options, as in a config file
+    """
+    dataset = os.path.join(directory, "dataset.tsv")
+    write_dataset(dataset, docs, seed)
+
+    indexer = create_indexer(directory, **options)
+    indexer.index_file(dataset)
+    return indexer.merge_dir
+
+
+def random_queries(n_queries, length, seed=0, vocabulary_size=20_000, max_rank=300):
+    """Return queries with `length` words chosen among the `max_rank` most common words of the synthetic reviews."""
+
+    rng = random.Random(seed)
+    vocabulary = synthetic_vocabulary(vocabulary_size, seed)[:max_rank]
+    return [" ".join(rng.choices(vocabulary, k=length)) for _ in range(n_queries)]
+
+
+def benchmark_tokenizer(args):
+    """Compare the throughput of the tokenizer engines."""
+
+    documents = []
+    for line in itertools.islice(synthetic_reviews(args.docs, args.seed), 1, None):
+        doc = line.split('\t')
+        documents.append((doc[Review.TITLE] + " " + doc[Review.HEADLINE] + " " + doc[Review.BODY]).split())
+    n_tokens = sum(len(tokens) for tokens in documents)
+
+    rows = []
+    outputs = {}
+    for engine in ("default", "fast"):
+        elapsed = math.inf
+        for _ in range(args.repeat):
+            # a new tokenizer for every run so the cache starts empty
+            tokenizer = Tokenizer(engine=engine, cache_size=args.cache_size, stemmer=args.stemmer)
+
+            start = time.perf_counter()
+            outputs[engine] = [tokenizer.normalize_tokens(tokens) for tokens in documents]
+            elapsed = min(elapsed, time.perf_counter() - start)
+
+        rows.append([engine, n_tokens, sum(map(len, outputs[engine])), elapsed, n_tokens / elapsed])
+
+    print(tabulate(rows, headers=["Engine", "Tokens", "Terms", "Seconds", "Tokens/second"],
+                   floatfmt=".2f"))
+    print(f"\nSame output: {'yes' if outputs['default'] == outputs['fast'] else 'NO'}")
+
+
+def benchmark_top_k(args):
+    """
+    Compare the query latency of sorting every scored document with selecting the top documents,
+    and with skipping the documents that cannot be in the top (BM25 only).
+    """
+
+    with tempfile.TemporaryDirectory() as directory:
+        # MaxScore skips the blocks of postings of the binary index without decoding them
+        index_format = "binary" if args.ranking == "BM25" else "text"
+        merge_dir = build_index(directory, args.docs, args.seed, name=args.ranking, index_format=index_format)
+        indexer = Indexer.load_metadata(merge_dir)
+        indexer.set_posting_cache_size(args.posting_cache_size)
+        query = Query(indexer)
+        score = query.array_score if args.ranking == "BM25" else query.tf_idf_score
+
+        rows = []
+        for length in args.lengths:
+            queries = [query.indexer.tokenizer.normalize_tokens(q.split())
+                       for q in random_queries(args.queries, length, args.seed)]
+            queries = [terms for terms in queries if terms]
+
+            latencies = {"sort": [], "top-k": []}
+            if args.ranking == "BM25":
+                latencies["maxscore"] = []
+            outputs = {mode: [] for mode in latencies}
+
+            for i, terms in enumerate(queries):
+                # alternates which selection runs first, so all benefit from warm caches alike
+                for mode in list(latencies)[::1 if i % 2 else -1]:
+                    latency = latencies[mode]
+                    start = time.perf_counter()
+                    if mode == "sort":
+                        results = score(terms)[:args.top]
+                    elif mode == "top-k":
+                        results = score(terms, args.top)
+                    else:
+                        results = query.bm25_max_score(terms, args.top)
+                    latency.append(time.perf_counter() - start)
+                    outputs[mode].append([(doc, round(score, 6)) for doc, score in results])
+
+            for mode, latency in latencies.items():
+                rows.append([length, mode, len(latency), 1000 * percentile(latency, 50),
+                             1000 * percentile(latency, 95), "yes" if outputs[mode] == outputs["sort"] else "NO"])
+
+        print(tabulate(rows, headers=["Query length", "Selection", "Queries", "p50 (ms)", "p95 (ms)",
+                                      "Same output"], floatfmt=".2f"))
+
+
+def benchmark_levenshtein(args):
+    """
+    Compare the edit distance functions on pairs of a query and a window, as compared by the boost,
+    where the windows have query terms, other terms and empty positions.
+    """
+    rng = random.Random(args.seed)
+    vocabulary = synthetic_vocabulary(100, args.seed)
+
+    rows = []
+    for length in args.lengths:
+        query = rng.sample(vocabulary, length)
+        # the windows of a query repeat, as the same terms are near each other in many documents
+        windows = [[rng.choice(query + [None, rng.choice(vocabulary)]) for _ in range(length)]
+                   for _ in range(args.windows)]
+        pairs = [(query, rng.choice(windows)) for _ in range(args.pairs)]
+
+        functions = {"dp": levenshtein_dp, "bit-parallel": levenshtein_bit_parallel, "memoized": levenshtein}
+        distances = {}
+        for name, function in functions.items():
+            levenshtein.cache_clear()
+
+            start = time.perf_counter()
+            distances[name] = [function(seq1, seq2) for seq1, seq2 in pairs]
+            elapsed = time.perf_counter() - start
+            rows.append([length, name, elapsed, len(pairs) / elapsed])
+
+        same = all(distances[name] == distances["dp"] for name in functions)
+        rows[-1].append("yes" if same else "NO")
+
+    print(tabulate(rows, headers=["Length", "Function", "Seconds", "Pairs/second", "Same output"],
+                   floatfmt=".4f"))
+
+
+def benchmark_bm25(args):
+    """
+    Compare the query latency of BM25 with the weights precomputed by the indexer
+    with the weights calculated by the searches from the term frequencies (query-time BM25).
+    """
+    with tempfile.TemporaryDirectory() as directory:
+        dataset = os.path.join(directory, "dataset.tsv")
+        write_dataset(dataset, args.docs, args.seed)
+
+        queries = {}
+        for name, query_time_bm25 in (("precomputed", False), ("query-time", True)):
+            index_dir = os.path.join(directory, name)
+            os.mkdir(index_dir)
+            indexer = create_indexer(index_dir, name="BM25", k1=1.2, b=0.75, index_format=args.index_format,
+                                     query_time_bm25=query_time_bm25)
+            indexer.index_file(dataset)
+
+            indexer = Indexer.load_metadata(indexer.merge_dir)
+            # every posting list is read from disk, as on the first search of each term
+            indexer.set_posting_cache_size(0)
+            queries[name] = Query(indexer)
+
+        rows = []
+        for length in args.lengths:
+            texts = random_queries(args.queries, length, args.seed)
+            runs = {"precomputed": {}, "query-time": {}, "query-time k1=2 b=0.5": {"k1": 2, "b": 0.5}}
+
+            results = {}
+            for name, parameters in runs.items():
+                query = queries[name.split()[0]]
+                latencies = []
+                results[name] = []
+                for text in texts:
+                    start = time.perf_counter()
+                    results[name].append(query.search(text, args.top, **parameters) or [])
+                    latencies.append(time.perf_counter() - start)
+
+                rows.append([length, name, 1000 * percentile(latencies, 50), 1000 * percentile(latencies, 95)])
+
+            # the precomputed weights are rounded when written to disk
+            difference = max((abs(s1 - s2) for r1, r2 in zip(results["precomputed"], results["query-time"])
+                              for (_, s1), (_, s2) in zip(r1, r2)), default=0)
+            rows[-2].append(difference)
+
+    print(tabulate(rows, headers=["Length", "Weights", "p50 (ms)", "p95 (ms)", "Max score difference"],
+                   floatfmt=("", "", ".3f", ".3f", ".1e")))
+
+
+def git_version():
+    """Return the commit of the source code, if it is in a git repository."""
+
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_index(directory, dataset, queries, args, **options):
+    """
+    Index a dataset and search queries in it, measuring each step.
+
+    @param directory: the directory where the index is written
+    @param dataset: the dataset filename
+    @param queries: the queries searched
+    @param args: the arguments of the suite
+    @param options: the indexer, tokenizer and ranking options, as in a config file
+    @return: a dict with the measures
+    """
+    indexer = create_indexer(directory, **options)
+
+    start = time.perf_counter()
+    indexer.index_file(dataset)
+    index_time = time.perf_counter() - start
+    merge_time = indexer.instrumentation.phases["merge_block_disk"].total
+
+    startup_times = []
+    for _ in range(args.repeat):
+        start = time.perf_counter()
+        loaded = Indexer.load_metadata(indexer.merge_dir)
+        startup_times.append(time.perf_counter() - start)
+
+    # every posting list is read from disk, so the latency does not depend on previous queries
+    loaded.set_posting_cache_size(0)
+    query = Query(loaded)
+    latencies = []
+    for q in queries:
+        start = time.perf_counter()
+        query.search(q, args.top)
+        latencies.append(time.perf_counter() - start)
+    loaded.close()
+
+    return {
+        "index_time": index_time,
+        "merge_time": merge_time,
+        "docs_per_second": args.docs / index_time,
+        "bytes_per_second": os.path.getsize(dataset) / index_time,
+        "index_size": get_directory_size(indexer.merge_dir),
+        "segments": len(indexer.segments),
+        "vocabulary_size": indexer.vocabulary_size,
+        "startup_time": percentile(startup_times, 50),
+        "query_latency": {
+            "mean": sum(latencies) / len(latencies),
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        },
+    }
+
+
+def benchmark_suite(args):
+    """
+    Measure the indexing and the searches of a synthetic dataset with both rankings,
+    with and without positions and zipped index files, and save the results as JSON.
+    """
+    results = {
+        "version": git_version(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "parameters": {name: getattr(args, name) for name in
+                       ("docs", "seed", "queries", "lengths", "top", "block_threshold", "index_format", "workers")},
+        "runs": [],
+    }
+
+    rows = []
+    with tempfile.TemporaryDirectory() as directory:
+        dataset = os.path.join(directory, "dataset.tsv")
+        write_dataset(dataset, args.docs, args.seed)
+        queries = [q for length in args.lengths for q in random_queries(args.queries, length, args.seed)]
+
+        for ranking, positional, save_zip in itertools.product(args.rankings, (False, True), (False, True)):
+            options = {"name": ranking, "positional": positional, "save_zip": save_zip,
+                       "block_threshold": args.block_threshold, "index_format": args.index_format,
+                       "workers": args.workers}
+            run_dir = os.path.join(directory, f"{ranking}-{positional}-{save_zip}")
+            os.mkdir(run_dir)
+
+            measures = benchmark_index(run_dir, dataset, queries, args, **options)
+            results["runs"].append({"ranking": ranking, "positional": positional, "save_zip": save_zip,
+                                    **measures})
+
+            latency = measures["query_latency"]
+            rows.append([ranking, positional, save_zip, measures["index_time"], measures["merge_time"],
+                         measures["docs_per_second"], measures["index_size"] / 1024**2, measures["startup_time"],
+                         1000 * latency["p50"], 1000 * latency["p95"], 1000 * latency["p99"]])
+
+    print(tabulate(rows, headers=["Ranking", "Positional", "Zip", "Index (s)", "Merge (s)", "Docs/second",
+                                  "Size (MB)", "Startup (s)", "p50 (ms)", "p95 (ms)", "p99 (ms)"],
+                   floatfmt=".2f"))
+
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {args.output}")
+
+
+# measures compared between suite results, all of them are better when lower
+COMPARED_MEASURES = {
+    "index_time": lambda run: run["index_time"],
+    "merge_time": lambda run: run["merge_time"],
+    "index_size": lambda run: run["index_size"],
+    "startup_time": lambda run: run["startup_time"],
+    "query_p50": lambda run: run["query_latency"]["p50"],
+    "query_p95": lambda run: run["query_latency"]["p95"],
+}
+
+
+def benchmark_compare(args):
+    """Compare the results of two suites, failing if any measure is worse than the threshold."""
+
+    with open(args.baseline, "r") as f:
+        baseline = json.load(f)
+    with open(args.results, "r") as f:
+        results = json.load(f)
+
+    def runs(data):
+        return {(run["ranking"], run["positional"], run["save_zip"]): run for run in data["runs"]}
+
+    baseline_runs = runs(baseline)
+    rows = []
+    regressions = 0
+    for key, run in runs(results).items():
+        if key not in baseline_runs:
+            continue
+        for measure, get in COMPARED_MEASURES.items():
+            old, new = get(baseline_runs[key]), get(run)
+            change = (new - old) / old if old else 0
+            regression = change > args.threshold
+            regressions += regression
+            rows.append([*key, measure, old, new, f"{change:+.1%}", "REGRESSION" if regression else ""])
+
+    print(f"Baseline: {baseline.get('version')}, results: {results.get('version')}\n")
+    print(tabulate(rows, headers=["Ranking", "Positional", "Zip", "Measure", "Baseline", "Results", "Change", ""],
+                   floatfmt=".4f"))
+    print(f"\n{regressions} regressions above {args.threshold:.0%}")
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+
+    logging.basicConfig(level=logging.WARNING)
+
+    parser = argparse.ArgumentParser(
+        description='Benchmarks of the indexer over synthetic review datasets')
+
+    subparser = parser.add_subparsers(
+        title='benchmark argument', dest='benchmark', required=True, help='benchmark to run')
+
+    t_parser = subparser.add_parser('tokenizer',
+                                    help='compare the throughput of the tokenizer engines')
+    t_parser.add_argument('--docs', metavar='N', type=int, default=20_000,
+                          help='number of synthetic reviews (default: %(default)s)')
+    t_parser.add_argument('--seed', metavar='N', type=int, default=0,
+                          help='seed of the synthetic reviews (default: %(default)s)')
+    t_parser.add_argument('--stemmer', action='store_true',
+                          help='stemmerize the tokens')
+    t_parser.add_argument('--cache-size', metavar='SIZE', type=int, default=0,
+                          help='size of the normalization cache (default: %(default)s)')
+    t_parser.add_argument('--repeat', metavar='N', type=int, default=3,
+                          help='number of runs of each engine, the fastest is reported (default: %(default)s)')
+
+    k_parser = subparser.add_parser('top-k',
+                                    help='compare the query latency of a full sort with a top-k selection and MaxScore')
+    k_parser.add_argument('--docs', metavar='N', type=int, default=20_000,
+                          help='number of synthetic reviews (default: %(default)s)')
+    k_parser.add_argument('--seed', metavar='N', type=int, default=0,
+                          help='seed of the synthetic reviews and queries (default: %(default)s)')
+    k_parser.add_argument('--ranking', choices=['VSM', 'BM25'], default="BM25",
+                          help='the type of ranking (default: %(default)s)')
+    k_parser.add_argument('--queries', metavar='N', type=int, default=50,
+                          help='number of queries of each length (default: %(default)s)')
+    k_parser.add_argument('--lengths', metavar='N', type=int, nargs='+', default=[1, 2, 4, 8],
+                          help='number of words of the queries (default: %(default)s)')
+    k_parser.add_argument('--top', metavar='K', type=int, default=10,
+                          help='number of results of each query (default: %(default)s)')
+    k_parser.add_argument('--posting-cache-size', metavar='BYTES', type=int, default=64 * 1024**2,
+                          help='memory budget of the posting lists cache, 0 disables it (default: %(default)s)')
+
+    b_parser = subparser.add_parser('bm25',
+                                    help='compare the query latency of precomputed and query-time BM25 weights')
+    b_parser.add_argument('--docs', metavar='N', type=int, default=20_000,
+                          help='number of synthetic reviews (default: %(default)s)')
+    b_parser.add_argument('--seed', metavar='N', type=int, default=0,
+                          help='seed of the synthetic reviews and queries (default: %(default)s)')
+    b_parser.add_argument('--queries', metavar='N', type=int, default=200,
+                          help='number of queries of each length (default: %(default)s)')
+    b_parser.add_argument('--lengths', metavar='N', type=int, nargs='+', default=[1, 2, 4, 8],
+                          help='number of words of the queries (default: %(default)s)')
+    b_parser.add_argument('--top', metavar='K', type=int, default=10,
+                          help='number of results of each query (default: %(default)s)')
+    b_parser.add_argument('--index-format', choices=['text', 'binary'], default="binary",
+                          help='format of the index segments (default: %(default)s)')
+
+    l_parser = subparser.add_parser('levenshtein',
+                                    help='compare the edit distance functions used by the boost')
+    l_parser.add_argument('--seed', metavar='N', type=int, default=0,
+                          help='seed of the sequences (default: %(default)s)')
+    l_parser.add_argument('--lengths', metavar='N', type=int, nargs='+', default=[3, 5, 10, 20],
+                          help='length of the query and of the windows (default: %(default)s)')
+    l_parser.add_argument('--pairs', metavar='N', type=int, default=10_000,
+                          help='number of pairs compared for each length (default: %(default)s)')
+    l_parser.add_argument('--windows', metavar='N', type=int, default=500,
+                          help='number of distinct windows of each query (default: %(default)s)')
+
+    g_parser = subparser.add_parser('generate',
+                                    help='write a synthetic dataset with the columns of the Amazon reviews')
+    g_parser.add_argument('output', metavar='FILE',
+                          help='the dataset filename, zipped if it ends with .gz')
+    g_parser.add_argument('--docs', metavar='N', type=int, default=20_000,
+                          help='number of synthetic reviews (default: %(default)s)')
+    g_parser.add_argument('--seed', metavar='N', type=int, default=0,
+                          help='seed of the synthetic reviews (default: %(default)s)')
+
+    s_parser = subparser.add_parser('suite',
+                                    help='measure the indexing and the searches with both rankings, with and without '
+                                    'positions and zipped index files')
+    s_parser.add_argument('--docs', metavar='N', type=int, default=20_000,
+                          help='number of synthetic reviews (default: %(default)s)')
+    s_parser.add_argument('--seed', metavar='N', type=int, default=0,
+                          help='seed of the synthetic reviews and queries (default: %(default)s)')
+    s_parser.add_argument('--rankings', choices=['VSM', 'BM25'], nargs='+', default=['VSM', 'BM25'],
+                          help='the rankings measured (default: %(default)s)')
+    s_parser.add_argument('--queries', metavar='N', type=int, default=50,
+                          help='number of queries of each length (default: %(default)s)')
+    s_parser.add_argument('--lengths', metavar='N', type=int, nargs='+', default=[1, 2, 4],
+                          help='number of words of the queries (default: %(default)s)')
+    s_parser.add_argument('--top', metavar='K', type=int, default=10,
+                          help='number of results of each query (default: %(default)s)')
+    s_parser.add_argument('--block-threshold', metavar='THRESHOLD', type=int, default=200_000,
+                          help='maximum number of postings stored in a block (default: %(default)s)')
+    s_parser.add_argument('--index-format', choices=['text', 'binary'], default="text",
+                          help='format of the index segments (default: %(default)s)')
+    s_parser.add_argument('--workers', metavar='N', type=int, default=1,
+                          help='number of processes used to index (default: %(default)s)')
+    s_parser.add_argument('--repeat', metavar='N', type=int, default=5,
+                          help='number of times the index is loaded, the median is reported (default: %(default)s)')
+    s_parser.add_argument('-o', '--output', metavar='FILE', default="benchmark.json",
+                          help='file where the results are written as JSON (default: %(default)s)')
+
+    c_parser = subparser.add_parser('compare',
+                                    help='compare the results of two suites')
+    c_parser.add_argument('baseline', metavar='BASELINE',
+                          help='the JSON results of the suite used as reference')
+    c_parser.add_argument('results', metavar='RESULTS',
+                          help='the JSON results of the suite compared')
+    c_parser.add_argument('--threshold', metavar='RATIO', type=float, default=0.1,
+                          help='relative increase of a measure above which it is a regression (default: %(default)s)')
+
+    args = parser.parse_args()
+
+    if args.benchmark == 'tokenizer':
+        benchmark_tokenizer(args)
+    elif args.benchmark == 'top-k':
+        benchmark_top_k(args)
+    elif args.benchmark == 'bm25':
+        benchmark_bm25(args)
+    elif args.benchmark == 'levenshtein':
+        benchmark_levenshtein(args)
+    elif args.benchmark == 'generate':
+        write_dataset(args.output, args.docs, args.seed)
+    elif args.benchmark == 'suite':
+        benchmark_suite(args)
+    elif args.benchmark == 'compare':
+        benchmark_compare(args)
@@ -1,35 +1,146 @@
 # Bruno Bastos 93302
 # Leandro Silva 93446
 
+import bisect
+import functools
 import logging
 import json
 import math
 import os
 import glob
 import gzip
+import heapq
+import itertools
+import mmap
+import queue
+import shutil
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from collections import deque
+from multiprocessing import Pool
+import numpy as np
 from tokenizer import Tokenizer
-from utils import convert_size, get_directory_size
+from instrumentation import Instrumentation
+from utils import convert_size, get_directory_size, get_object_size, encode_varint, decode_varint, read_varint, \
+    LRUCache
 from query import BM25, VSM
 
 
+# state of the tokenization worker processes, set up once by `_init_tokenize_worker`
+_worker_tokenizer = None
+_worker_ranking = None
+
+
+def _init_tokenize_worker(tokenizer, ranking):
+    global _worker_tokenizer, _worker_ranking
+    _worker_tokenizer = tokenizer
+    _worker_ranking = ranking
+
+
+def _tokenize_lines(lines):
+    """Tokenize a batch of lines in a worker process and compute their ranking info."""
+
+    documents = []
+    for line in lines:
+        terms, doc = _worker_tokenizer.tokenize(line)
+        documents.append((terms, doc, terms and term_statistics(terms, _worker_ranking)))
+    return documents
+
+
+# block merger of the merge worker processes, set up once by `_init_merge_worker`
+_worker_merger = None
+
+
+def _init_merge_worker(merger):
+    global _worker_merger
+    _worker_merger = merger
+
+
+def _merge_block_range(block_files, first_term, last_term, segment_name):
+    return _worker_merger.merge_block_range(block_files, first_term, last_term, segment_name)
+
+
+def term_statistics(terms, ranking):
+    """
+    Calculate the ranking info of a document.
+
+    @param terms: the list of terms provided by the tokenizer
+    @param ranking: the ranking of the indexer
+    @return: a dict with the term frequency and the weight (VSM only) of each term
+    """
+    if not ranking:
+        return None
+
+    terms_cnt = {}
+    for term, pos in terms:
+        terms_cnt.setdefault(term, 0)
+        terms_cnt[term] += 1
+
+    weights = {}
+    if ranking.name == "VSM":
+        # calculates weights depending on the schema provided
+        cos_norm = 0
+
+        for term, cnt in terms_cnt.items():
+            if ranking.p1[0] == "l":
+                # l**
+                weights[term] = 1 + math.log10(cnt)
+            elif ranking.p1[0] == "n":
+                # n**
+                weights[term] = cnt
+
+            cos_norm += weights[term]**2
+
+        if ranking.p1[2] == "c":
+            # **c
+            cos_norm = 1 / math.sqrt(cos_norm)
+            for term in terms_cnt:
+                weights[term] *= cos_norm
+
+    return {term: (cnt, weights.get(term)) for term, cnt in terms_cnt.items()}
+
+
 class TermInfo():
 
-    def __init__(self, posting_size=0, position=None, idf=None):
+    def __init__(self, posting_size=0, position=None, idf=None, offset=None, length=None, max_weight=None,
+                 group_offset=None):
         self.posting_size = posting_size
         self.position = position or None
-        self.idf = idf or None
+        self.idf = idf
+        # location of the term record in its index file, or of its group of records in a compressed index file
+        self.offset = offset
+        self.length = length
+        # location of the term record in its group of records, once decompressed
+        self.group_offset = group_offset
+        # upper bound of the weights of the term postings
+        self.max_weight = max_weight
 
     @staticmethod
     def create(line):
-        term, idf, position = line.strip().split(',')
-        return TermInfo(0, position and int(position), idf and float(idf))
+        term, idf, position, *location = line.strip().split(',')
+        offset, length, max_weight, df, group_offset = location + [None] * (5 - len(location))
+        # the document frequency is not stored by the indexes created before the generations were appended
+        return TermInfo(df and int(df) or 0, position and int(position), float(idf) if idf else None,
+                        offset and int(offset), length and int(length), max_weight and float(max_weight),
+                        group_offset and int(group_offset))
 
     def write(self):
-        # TODO: BM25 remove idf and fix this error
-        return f"{self.idf or '':.6f},{self.position or ''}"
+        # the terms of every document have an idf of 0, such as the ones of a generation with a single document
+        location = ""
+        if self.offset is not None:
+            location = f",{self.offset},{self.length},{self.max_weight:.6f},{self.posting_size}"
+            if self.group_offset is not None:
+                location += f",{self.group_offset}"
+        return f"{self.idf or 0:.6f},{self.position or ''}{location}"
 
 
 class PostingInfo():
+    # fixed width of the weights in the binary index
+    WEIGHT = struct.Struct("<f")
+
     def __init__(self, doc_id, term_freq, positions, weight=None):
         self.doc_id = doc_id
         self.positions = positions
@@ -63,16 +174,638 @@ class PostingInfo():
             p = ',' + self.positions
         return f"{self.doc_id},{w}{p}"
 
+    def write_to_binary_index(self, out, last_doc_id):
+        # doc gap,w,#pos,pos gaps
+        doc_id = int(self.doc_id)
+        encode_varint(doc_id - last_doc_id, out)
+        out += PostingInfo.WEIGHT.pack(self.weight or 0)
+        if self.positions is not None:
+            positions = [int(pos) for pos in self.positions.split(',')] if self.positions else []
+            encode_varint(len(positions), out)
+            last_pos = 0
+            for pos in positions:
+                encode_varint(pos - last_pos, out)
+                last_pos = pos
+        return doc_id
+
+
+class PostingBlocks():
+    """
+    Posting list of a term split in blocks of consecutive postings, with the last document and the highest weight
+    of each block, so the searches can skip the blocks that cannot change their results without decoding them.
+    """
+
+    def __init__(self, last_docs, max_weights, decode_block):
+        self.last_docs = last_docs          # array with the last document of each block
+        self.max_weights = max_weights      # array with the highest weight of each block
+        self.decode_block = decode_block    # gets the arrays of the documents and the weights of a block
+
+    def __len__(self):
+        return len(self.last_docs)
+
+    @staticmethod
+    def from_arrays(doc_ids, weights, block_size):
+        """Split the arrays of the document IDs and the weights of a posting list in blocks of `block_size`."""
+
+        starts = np.arange(0, len(doc_ids), block_size)
+        ends = np.minimum(starts + block_size, len(doc_ids))
+        return PostingBlocks(doc_ids[ends - 1], np.maximum.reduceat(weights, starts),
+                             lambda k: (doc_ids[starts[k]:ends[k]], weights[starts[k]:ends[k]]))
+
+
+class TermPostings():
+    """Postings of a term in a block, as arrays with an item for each posting."""
+
+    __slots__ = ("docs", "term_freqs", "weights", "positions", "ends")
+
+    def __init__(self):
+        self.docs = array("I")          # index of the document in the documents of the block
+        self.term_freqs = array("I")
+        self.weights = array("d")       # VSM only
+        self.positions = array("I")     # positions of all postings, one after the other
+        self.ends = array("I")          # end of the positions of each posting
+
+
+class Block():
+    """
+    The postings of the documents indexed since the last block was written to disk.
+    The postings are stored in arrays, with the positions as integers, and the terms are interned,
+    so the memory used by the block can be estimated from the number of terms, postings and positions.
+    """
+
+    # estimated bytes of each term, posting, position and document, including the dict and list entries
+    TERM_SIZE = 100 + sys.getsizeof(TermPostings()) + 5 * sys.getsizeof(array("I"))
+    POSTING_SIZE = array("I").itemsize * 3 + array("d").itemsize
+    POSITION_SIZE = array("I").itemsize
+    DOCUMENT_SIZE = 8 + sys.getsizeof("R" * 14)
+
+    def __init__(self, positional=False, weights=False):
+        self.positional = positional
+        self.store_weights = weights
+
+        self.docs = []          # IDs of the documents of the block
+        self.postings = {}      # {term: TermPostings}
+        self.n_postings = 0
+        self.n_positions = 0
+        self.n_tokens = 0       # terms of the documents of the block, with repetitions
+        self.__term_bytes = 0
+
+    def __len__(self):
+        return len(self.postings)
+
+    @property
+    def size(self):
+        """Estimated bytes used by the block."""
+        return len(self.postings) * self.TERM_SIZE + self.__term_bytes + self.n_postings * self.POSTING_SIZE \
+            + self.n_positions * self.POSITION_SIZE + len(self.docs) * self.DOCUMENT_SIZE
+
+    def add(self, doc, terms, stats=None):
+        """
+        Add the postings of a document.
+
+        @param doc: the document ID
+        @param terms: the list of terms and positions provided by the tokenizer
+        @param stats: the term frequency and weight of each term, as calculated by `term_statistics`
+        """
+        i = len(self.docs)
+        self.docs.append(doc)
+        self.n_tokens += len(terms)
+
+        positions = {}
+        if self.positional or stats is None:
+            for term, pos in terms:
+                positions.setdefault(term, []).append(pos)
+        if stats is None:
+            stats = {term: (len(term_positions), None) for term, term_positions in positions.items()}
+
+        for term, (cnt, weight) in stats.items():
+            if (postings := self.postings.get(term)) is None:
+                term = sys.intern(term)
+                postings = self.postings[term] = TermPostings()
+                self.__term_bytes += sys.getsizeof(term)
+
+            postings.docs.append(i)
+            postings.term_freqs.append(cnt)
+            if self.store_weights:
+                postings.weights.append(weight)
+            if self.positional:
+                postings.positions.extend(positions[term])
+                postings.ends.append(len(postings.positions))
+                self.n_positions += cnt
+        self.n_postings += len(stats)
+
+    def write(self, f):
+        """
+        Write the block to a file, with a line for each term, sorted, followed by its postings.
+
+        @return: the number of postings of each term
+        """
+        posting_sizes = {}
+        for term in sorted(self.postings):
+            postings = self.postings[term]
+            f.write(term)
+            # term doc1,w,tf,pos1,pos2 doc2,pos1
+            start = 0
+            for p, doc in enumerate(postings.docs):
+                weight = postings.weights[p] if self.store_weights else None
+                positions = None
+                if self.positional:
+                    end = postings.ends[p]
+                    positions = ",".join(map(str, postings.positions[start:end]))
+                    start = end
+
+                f.write(" " + PostingInfo(self.docs[doc], postings.term_freqs[p],
+                                          positions, weight).write_to_block())
+            f.write("\n")
+            posting_sizes[term] = len(postings.docs)
+        return posting_sizes
+
+    def clear(self):
+        self.docs = []
+        self.postings = {}
+        self.n_postings = self.n_positions = self.n_tokens = self.__term_bytes = 0
+
+
+class SegmentWriter():
+    """
+    Writes the term records of an index file and keeps the byte location of each record.
+    When compressed, the records are written in groups of about `GROUP_SIZE` bytes and the stream is fully
+    flushed after every group, so each group can be decompressed on its own while the file is still a valid
+    gzip file. Flushing after every record would compress each small record on its own.
+    """
+
+    # uncompressed bytes of the records of a group
+    GROUP_SIZE = 64 * 1024
+
+    def __init__(self, filename, compress=False):
+        self.filename = filename
+        self.file = open(filename, "wb")
+        # the header has no name or time, so the file only depends on its records
+        self.stream = gzip.GzipFile("", "wb", fileobj=self.file, mtime=0) if compress else self.file
+        self.compress = compress
+        self.offset = self.file.tell()
+
+        # [(term, offset, length, offset in the group)] of the written records, the offset and length of
+        # a compressed record are the ones of its group, known once the group is flushed
+        self.locations = []
+        self.__group = []           # locations of the records of the group being written
+        self.__group_size = 0
+
+        # term range and size of the written records
+        self.first_term = None
+        self.last_term = None
+        self.n_terms = 0
+        self.n_postings = 0
+
+    def write_term(self, term, record, n_postings):
+        if self.first_term is None:
+            self.first_term = term
+        self.last_term = term
+        self.n_terms += 1
+        self.n_postings += n_postings
+
+        self.stream.write(record)
+        if not self.compress:
+            offset = self.offset
+            self.offset = self.file.tell()
+            self.locations.append((term, offset, self.offset - offset, None))
+            return
+
+        self.__group.append((term, self.__group_size))
+        self.__group_size += len(record)
+        if self.__group_size >= self.GROUP_SIZE:
+            self.__flush_group()
+
+    def __flush_group(self):
+        if not self.__group:
+            return
+        self.stream.flush(zlib.Z_FULL_FLUSH)
+
+        offset = self.offset
+        self.offset = self.file.tell()
+        self.locations.extend((term, offset, self.offset - offset, start) for term, start in self.__group)
+        self.__group = []
+        self.__group_size = 0
+
+    def close(self):
+        if self.compress:
+            self.__flush_group()
+            self.stream.close()
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BatchReader():
+    """
+    Reads the lines of a file in batches on a background thread, so reading and decompressing the file
+    overlap with the tokenization of the batches already read. The thread reads at most `read_ahead`
+    batches ahead, and when `read_ahead` is 0 the batches are read when iterated, without a thread.
+    """
+
+    def __init__(self, f, batch_size=1000, read_ahead=8):
+        self.f = f
+        self.batch_size = batch_size
+        self.read_ahead = read_ahead
+
+        self.queue = queue.Queue(read_ahead) if read_ahead else None
+        self.stopped = threading.Event()
+        self.error = None
+        self.thread = None
+
+    def __batches(self):
+        while (batch := list(itertools.islice(self.f, self.batch_size))):
+            yield batch
+
+    def __read(self):
+        try:
+            for batch in self.__batches():
+                if not self.__put(batch):
+                    return
+        except Exception as e:
+            self.error = e
+        self.__put(None)
+
+    def __put(self, batch):
+        """Wait for room in the queue to put a batch, unless the reader is closed."""
+
+        while not self.stopped.is_set():
+            try:
+                self.queue.put(batch, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+
+    def __iter__(self):
+        if not self.read_ahead:
+            yield from self.__batches()
+            return
+
+        # the thread starts when the batches are first needed
+        self.thread = threading.Thread(target=self.__read, name="BatchReader", daemon=True)
+        self.thread.start()
+        while (batch := self.queue.get()) is not None:
+            yield batch
+        if self.error:
+            raise self.error
+
+    def close(self):
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class DocTermMatrix():
+    """
+    The weights of an index as a doc×term matrix in compressed sparse row (CSR) format.
+    The weights of the document in row `i` are `data[indptr[i]:indptr[i + 1]]`,
+    in the term columns `indices[indptr[i]:indptr[i + 1]]`.
+    """
+
+    FILES = ("indptr", "indices", "data")
+
+    def __init__(self, indptr, indices, data, docs, terms):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.docs = docs
+        self.terms = terms
+        self.columns = {term: column for column, term in enumerate(terms)}
+
+        # entries sorted by column, so the entries of a term are a slice, and the row of every entry
+        self.column_order = np.argsort(indices, kind="stable")
+        self.column_ptr = np.searchsorted(indices[self.column_order], np.arange(len(terms) + 1))
+        self.rows = np.repeat(np.arange(len(docs)), np.diff(indptr))
+
+    @property
+    def shape(self):
+        return len(self.docs), len(self.terms)
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    def save(self, directory):
+        if not os.path.exists(directory):
+            os.mkdir(directory)
+
+        for name in DocTermMatrix.FILES:
+            np.save(f"{directory}{name}.npy", getattr(self, name))
+        with open(f"{directory}docs.txt", "w") as f:
+            f.writelines(f"{doc}\n" for doc in self.docs)
+        with open(f"{directory}terms.txt", "w") as f:
+            f.writelines(f"{term}\n" for term in self.terms)
+
+    @staticmethod
+    def load(directory):
+        arrays = [np.load(f"{directory}{name}.npy") for name in DocTermMatrix.FILES]
+        with open(f"{directory}docs.txt", "r") as f:
+            docs = [line.rstrip("\n") for line in f]
+        with open(f"{directory}terms.txt", "r") as f:
+            terms = [line.rstrip("\n") for line in f]
+        return DocTermMatrix(*arrays, docs, terms)
+
+    def dot(self, queries):
+        """
+        Score the documents for a batch of queries, as the product of the matrix with the query vectors.
+        The scores are only accumulated for the (query, document) pairs with at least one query term,
+        so the memory used is the one of the postings of the batch and not of a row of documents for each query.
+
+        @param queries: a list with a dict {term: weight} for each query
+        @return: for each query, the rows of the documents with at least one query term and their scores
+        """
+        n_docs = len(self.docs)
+        keys, values = [], []
+        for j, query in enumerate(queries):
+            for term, weight in query.items():
+                if (column := self.columns.get(term)) is None:
+                    continue
+                entries = self.column_order[self.column_ptr[column]:self.column_ptr[column + 1]]
+                keys.append(self.rows[entries] + j * n_docs)
+                values.append(self.data[entries].astype(np.float64) * weight)
+
+        if not keys:
+            return [(np.empty(0, dtype=np.int64), np.empty(0)) for _ in queries]
+
+        # the keys are sorted, so the pairs of each query are together and their documents are sorted
+        keys, pairs = np.unique(np.concatenate(keys), return_inverse=True)
+        scores = np.bincount(pairs, np.concatenate(values), minlength=len(keys))
+        bounds = np.searchsorted(keys, np.arange(len(queries) + 1) * n_docs)
+
+        results = []
+        for j in range(len(queries)):
+            rows = keys[bounds[j]:bounds[j + 1]] - j * n_docs
+            results.append((rows, scores[bounds[j]:bounds[j + 1]]))
+        return results
+
+
+# first bytes of a gzip file
+GZIP_MAGIC = b"\x1f\x8b"
+
+# bytes of the groups of records of the compressed index files kept decompressed by the searches
+GROUP_CACHE_SIZE = 4 * 1024**2
+
+# postings of each block of the posting lists skipped by the searches
+POSTING_BLOCK_SIZE = 128
+
+
+class BlockMerger():
+    """
+    Merges the terms of the block files into the index files. It only has the configurations of the index
+    files and, for the precomputed BM25 weights, the idf of the terms and the length of the documents,
+    so the worker processes of a parallel merge get it instead of the whole indexer.
+    """
+
+    def __init__(self, merge_dir, index_format="text", positional=False, save_zip=False, merge_threshold=1_000_000,
+                 merge_chunk_size=1000, file_location_step=0, posting_block_size=POSTING_BLOCK_SIZE,
+                 query_time_bm25=False, ranking=None, idf=None, document_lens=None, avg_doc_len=None):
+        """
+        @param ranking: the ranking of the index, only needed by the precomputed BM25 weights
+        @param idf: the idf of each term, only needed by the precomputed BM25 weights
+        @param document_lens: the number of terms of each document, only needed by the precomputed BM25 weights
+        @param avg_doc_len: the average number of terms of the documents, only needed by the precomputed BM25 weights
+        """
+        self.merge_dir = merge_dir
+        self.index_format = index_format
+        self.positional = positional
+        self.save_zip = save_zip
+        self.merge_threshold = merge_threshold
+        self.merge_chunk_size = merge_chunk_size
+        self.file_location_step = file_location_step
+        self.posting_block_size = posting_block_size
+        self.query_time_bm25 = query_time_bm25
+        # the BM25 weights are calculated before being written to disk
+        self.bm25 = not query_time_bm25 and ranking is not None and ranking.name == "BM25"
+        self.ranking = ranking
+        self.idf = idf
+        self.document_lens = document_lens
+        self.avg_doc_len = avg_doc_len
+
+        self.__locations = {}      # {term: [position, offset, length, group offset, max weight]}
+        self.__segments = []
+
+    @property
+    def segment_extension(self):
+        return ".bin" if self.index_format == "binary" else ".txt"
+
+    def merge_block_range(self, block_files, first_term=None, last_term=None, segment_name="segment.tmp"):
+        """
+        Merge the terms of the blocks in the range [`first_term`, `last_term`[ into new index files.
+
+        @param block_files: the block filenames, in the order they were written
+        @param first_term: the first term of the range, or None to start on the first term
+        @param last_term: the term after the range, or None to end on the last term
+        @param segment_name: the temporary name of the index file being written
+        @return: the location of the terms written, as (term, position, offset, length, group offset,
+            max weight), and the new index files, as (first term, last term, filename)
+        """
+        self.__locations = {}
+        self.__segments = []
+
+        blocks = [open(block, "rb") for block in block_files]
+        segment = None
+        try:
+            if first_term is not None:
+                for f in blocks:
+                    self.__seek_block(f, first_term)
+
+            for term, postings in self.__merge_blocks(blocks, last_term):
+                if segment is None:
+                    segment = SegmentWriter(self.merge_dir + segment_name, self.save_zip)
+
+                self.__store_term(segment, term, postings)
+
+                # starts a new index file when the postings exceed the threshold
+                if segment.n_postings >= self.merge_threshold:
+                    self.__close_segment(segment)
+                    segment = None
+
+            if segment is not None:
+                self.__close_segment(segment)
+        finally:
+            for f in blocks:
+                f.close()
+
+        return [(term, *location) for term, location in self.__locations.items()], self.__segments
+
+    @staticmethod
+    def __line_start(f, pos):
+        """Move the file to the start of the first line that starts at `pos` or after it."""
+        if pos:
+            f.seek(pos - 1)
+            f.readline()
+        else:
+            f.seek(0)
+
+    def __seek_block(self, f, term):
+        """Move the block file to the first line whose term is not smaller than `term`."""
+
+        term = term.encode()
+        low, high = 0, os.fstat(f.fileno()).st_size
+        while low < high:
+            mid = (low + high) // 2
+            self.__line_start(f, mid)
+            line = f.readline()
+            if line and line.split(b" ", 1)[0] < term:
+                low = mid + 1
+            else:
+                high = mid
+        self.__line_start(f, low)
+
+    def __read_block(self, f, block, last_term=None):
+        """Yield the terms and postings of a block file, reading it by chunks, until `last_term`."""
+
+        while (chunk := f.readlines(self.merge_chunk_size)):
+            for line in chunk:
+                term, postings = line.decode().rstrip("\n").split(" ", 1)
+                if last_term is not None and term >= last_term:
+                    return
+                yield term, block, postings
+
+    def __merge_blocks(self, blocks, last_term=None):
+        """Yield every term, sorted, with the postings of all blocks in the order of the blocks."""
+
+        # the heap is ordered by term and then by block
+        merged = heapq.merge(*(self.__read_block(f, b, last_term) for b, f in enumerate(blocks)))
+        for term, group in itertools.groupby(merged, key=lambda entry: entry[0]):
+            yield term, " ".join(postings for _, _, postings in group).split(" ")
+
+    def __store_term(self, segment, term, postings):
+        """Write a term and its postings, as read from the blocks, to an index file."""
+
+        if self.index_format == "binary":
+            record, max_weight = self.__binary_term_record(term, postings)
+        else:
+            record, max_weight = self.__text_term_record(term, postings)
+
+        position = None
+        if self.file_location_step and segment.n_terms % self.file_location_step == 0:
+            position = segment.n_terms + 1
+        self.__locations[term] = [position, None, None, None, max_weight]
+        segment.write_term(term, record, len(postings))
+
+    def __close_segment(self, segment):
+        """Close an index file and name it after its term range."""
+
+        segment.close()
+        for term, *location in segment.locations:
+            self.__locations[term][1:4] = location
+
+        filename = f"{self.merge_dir}{segment.first_term} {segment.last_term}{self.segment_extension}"
+        if self.save_zip:
+            filename += ".gz"
+        logging.info(f"Writing index \"{segment.first_term} {segment.last_term}\" to disk")
+        os.replace(segment.filename, filename)
+
+        self.__segments.append((segment.first_term, segment.last_term, filename))
+
+    def __text_term_record(self, term, postings):
+        """Encode a term and its postings as a line of the text index and return it with the highest weight."""
+
+        line = [term]
+        max_weight = 0
+        for post in postings:
+            # doc,w,tf,pos -> doc,w,pos
+            if self.positional:
+                doc, w, tf, pos = post.split(",", 3)
+                pos = "," + pos
+            else:
+                doc, w, tf = post.split(",", 2)
+                pos = ""
+
+            if self.query_time_bm25:
+                # the searches calculate the weights from the term frequencies
+                w = tf
+            elif self.bm25:
+                # bm25 weights are calculated before being written to disk
+                # this way they are not kept in memory for long and can
+                # free space whenever they are written
+
+                # vsm weights were written to the blocks and now only the chunks
+                # are loaded into memory, so they are in memory for a short time aswell
+                weight = self.__bm25_weight(term, doc, int(tf))
+                w = f"{weight:.6f}" if weight else ""
+            line.append(f"{doc},{w}{pos}")
+            max_weight = max(max_weight, float(w or 0))
+
+        return (" ".join(line) + "\n").encode(), max_weight
+
+    def __binary_term_record(self, term, postings):
+        """
+        Encode a term and its postings, sorted by document, as a record of the binary index
+        and return it with the highest weight.
+        """
+
+        postings = [PostingInfo.create(post, self.positional) for post in postings]
+        if self.query_time_bm25:
+            # the searches calculate the weights from the term frequencies
+            for posting in postings:
+                posting.weight = posting.term_freq
+        elif self.bm25:
+            for posting in postings:
+                posting.weight = self.__bm25_weight(term, posting.doc_id, posting.term_freq)
+
+        record = bytearray()
+        term = term.encode()
+        encode_varint(len(term), record)
+        record += term
+        encode_varint(len(postings), record)
+
+        encoded = bytearray()
+        block_maxima = bytearray()
+        block_size = self.posting_block_size if len(postings) > self.posting_block_size else 0
+        last_doc_id = block_doc_id = block_end = 0
+        block_weight = 0
+        postings.sort(key=lambda posting: int(posting.doc_id))
+        for n, posting in enumerate(postings, 1):
+            last_doc_id = posting.write_to_binary_index(encoded, last_doc_id)
+            block_weight = max(block_weight, posting.weight or 0)
+            if block_size and (n % block_size == 0 or n == len(postings)):
+                # block -> last doc gap,postings bytes,max weight
+                encode_varint(last_doc_id - block_doc_id, block_maxima)
+                encode_varint(len(encoded) - block_end, block_maxima)
+                block_maxima += PostingInfo.WEIGHT.pack(block_weight)
+                block_doc_id, block_end, block_weight = last_doc_id, len(encoded), 0
+        record += block_maxima + encoded
+
+        size = bytearray()
+        encode_varint(len(record), size)
+        return bytes(size + record), max((posting.weight or 0 for posting in postings), default=0)
+
+    def __bm25_weight(self, term, doc, term_frequency):
+        """Calculate the BM25 weight of a term in a document."""
+
+        k1, b = self.ranking.k1, self.ranking.b
+        return self.idf[term] * (k1 + 1) * term_frequency / (k1 *
+            ((1 - b) + b * self.document_lens[doc] / self.avg_doc_len) + term_frequency)
+
 
 class Indexer:
 
     def __init__(self, tokenizer=Tokenizer(), positional=False, save_zip=False, rename_doc=False, file_location_step=0,
                  block_threshold=1_000_000, merge_threshold=1_000_000, merge_chunk_size=1000,
-                 ranking=VSM(), merge_dir="indexer/", **ignore):
+                 ranking=VSM(), merge_dir="indexer/", workers=1, index_format="text", int_doc_ids=False,
+                 posting_cache_size=64 * 1024**2, generation=0, read_ahead=8, block_memory=256 * 1024**2,
+                 query_time_bm25=False, merge_factor=10, generations=(), posting_block_size=POSTING_BLOCK_SIZE,
+                 **ignore):
 
         self.positional = positional
-        self.index = {}             # {term: {doc: [pos]}} || {term: [docs]}
+        self.block = Block(positional, ranking is not None and ranking.name == "VSM")
         self.term_info = {}         # {term: [df, file_loc]}
+        self.sorted_terms = ()      # terms of term_info sorted, built once the index is complete
+        self.segments = []          # [(first term, last term, filename)] of the index files, sorted by term
+        self.__segment_first_terms = []
 
         path, _ = os.path.split(os.path.abspath(__file__))
         self.merge_dir = merge_dir if os.path.isabs(
@@ -80,32 +813,74 @@ class Indexer:
 
         self.__block_cnt = 0
         self.block_threshold = block_threshold
+        # estimated bytes of memory of a block, the block is written when it uses more
+        self.block_memory = block_memory
         self.merge_threshold = merge_threshold
         self.merge_chunk_size = merge_chunk_size
 
         self.tokenizer = tokenizer
+        self.workers = workers
+        self.worker_batch_size = 1000
+        # batches of lines of the dataset read ahead by a background thread, 0 reads them in the main thread
+        self.read_ahead = read_ahead
 
         self.save_zip = save_zip
 
         self.ranking = ranking
 
-        # VSM
         self.__n_doc_indexed = 0
-        self.term_doc_weights = {}   # term_doc_weights keeps the information for either bm25 o
 
         # BM25
         self.document_lens = {}     # saves the number of words for each document
-        self.term_frequency = {}    # save
         self.__total_doc_lens = 0
 
+        # the BM25 weights are calculated by the searches from the term frequencies stored in the index,
+        # so the searches can change k1 and b
+        self.query_time_bm25 = query_time_bm25 and ranking is not None and ranking.name == "BM25"
+        if query_time_bm25 and not self.query_time_bm25:
+            logging.warning("Query-time BM25 requires the BM25 ranking. Storing the weights instead.")
+        self.doc_lens = None        # array with the number of terms of each document, read by the searches
+        self.avg_doc_len = None
+
         # rename document ID
         self.__last_rename = ""
         self.doc_ids = {}
-        self.rename_doc = rename_doc
+        # binary indexes delta encode the document IDs, so they need to be renamed as integers
+        self.index_format = index_format
+        # the documents are numbered in the order they are indexed, so the searches can score them in arrays
+        self.int_doc_ids = int_doc_ids or index_format == "binary" or self.query_time_bm25
+        self.rename_doc = rename_doc or self.int_doc_ids
+        # the records of the binary index with more postings store the last document and the highest weight
+        # of each block of postings, 0 stores none
+        self.posting_block_size = posting_block_size
 
         # file location
         self.file_location_step = file_location_step
-        self.__post_cnt = 0
+
+        # memory maps of the index files read by the searches
+        self.__segment_maps = {}
+        # groups of records of the compressed index files decompressed the most recently
+        self.__group_cache = LRUCache(GROUP_CACHE_SIZE, len)
+
+        # number of times the index directory was written, so the searches know when their results are outdated
+        self.generation = generation
+        # modification time of the config of the index directory when it was loaded, None if it was not
+        self.config_mtime = None
+
+        # subdirectories with the documents appended to the index, each one an index of its own, in the order
+        # they were indexed
+        self.generations = list(generations)
+        # number of appended generations of the same tier that are merged into one
+        self.merge_factor = merge_factor
+        # indexes of the directory and of every generation, read by the searches of an index with generations
+        self.generation_indexes = []
+
+        # decoded posting lists of the terms searched the most recently
+        self.posting_cache = None
+        self.set_posting_cache_size(posting_cache_size)
+
+        # time of the phases of the indexing and the searches
+        self.instrumentation = Instrumentation()
 
     @property
     def vocabulary_size(self):
@@ -115,18 +890,41 @@ class Indexer:
     def num_segments(self):
         return self.__block_cnt
 
+    @property
+    def num_docs(self):
+        """Number of documents indexed, known when the documents are renamed."""
+        return len(self.doc_ids)
+
+    @property
+    def segment_extension(self):
+        return ".bin" if self.index_format == "binary" else ".txt"
+
     @property
     def disk_size(self):
         return convert_size(get_directory_size(self.merge_dir))
 
     @staticmethod
-    def load_metadata(directory):
-        """Static method that creates an Indexer object from a directory using the metadata."""
+    def load_metadata(directory, generations=True):
+        """
+        Static method that creates an Indexer object from a directory using the metadata.
 
+        @param directory: the index directory
+        @param generations: load the generations appended to the index, otherwise only the index of the directory
+        """
+        # read before the config, so a config written meanwhile is seen as newer by `reload`
+        config_mtime = Indexer.read_config_mtime(directory)
         indexer = Indexer.read_config(directory + ".metadata/config.json")
+        indexer.config_mtime = config_mtime
+        if generations and indexer.generations:
+            indexer.load_generations()
+            return indexer
+
         indexer.read_term_info_memory()
+        indexer.read_segments()
         if indexer.rename_doc:
             indexer.read_doc_ids()
+        if indexer.query_time_bm25:
+            indexer.read_doc_lens()
 
         return indexer
 
@@ -141,6 +939,9 @@ class Indexer:
             tokenizer_data = data.get("tokenizer", {})
             ranking_data = data.get("ranking", {})
 
+            # the indexes created before the blocks of postings have no block maxima
+            indexer_data.setdefault("posting_block_size", 0)
+
             ranking = None
             if ranking_data.get("name") == "BM25":
                 ranking = BM25(**ranking_data)
@@ -164,9 +965,18 @@ class Indexer:
                 "rename_doc": False,
                 "file_location_step": 0,
                 "block_threshold": 1_000_000,
+                "block_memory": 256 * 1024**2,
                 "merge_threshold": 1_000_000,
                 "merge_chunk_size": 1000,
                 "merge_dir": "indexer/",
+                "workers": 1,
+                "read_ahead": 8,
+                "index_format": "text",
+                "int_doc_ids": False,
+                "posting_cache_size": 64 * 1024**2,
+                "query_time_bm25": False,
+                "merge_factor": 10,
+                "posting_block_size": POSTING_BLOCK_SIZE,
             }
             tokenizer = {
                 "min_length": 3,
@@ -174,7 +984,9 @@ class Indexer:
                 "no_numbers": True,
                 "stopwords_file": None,
                 "contractions_file": None,
-                "stemmer": True
+                "stemmer": True,
+                "cache_size": 100_000,
+                "engine": "default"
             }
             ranking = {
                 "name": "VS",
@@ -196,34 +1008,14 @@ class Indexer:
         if not os.path.exists(block_dir):
             os.mkdir(block_dir)
 
-        # resets the number of postings in memory
-        self.__post_cnt = 0
-
         with open(f"{block_dir}block{self.__block_cnt}.txt", "w+") as f:
             self.__block_cnt += 1
 
-            for term in sorted(self.index):
-                f.write(term)
-                # term doc1,w,tf,pos1,pos2 doc2,pos1
-                for doc in self.index[term]:
-                    weight = positions = None
-
-                    if self.ranking.name == 'VSM':
-                        weight = self.term_doc_weights[term][doc]
-                    if self.positional:
-                        positions = ','.join(self.index[term][doc])
-
-                    tf = self.term_frequency[term][doc]
-                    f.write(" " + PostingInfo(doc, tf,
-                                              positions, weight).write_to_block())
-                f.write("\n")
-                self.term_info.setdefault(
-                    term, TermInfo()).posting_size += len(self.index[term])
+            for term, posting_size in self.block.write(f).items():
+                self.term_info.setdefault(term, TermInfo()).posting_size += posting_size
 
         # frees memory
-        self.index.clear()
-        self.term_doc_weights.clear()
-        self.term_frequency.clear()
+        self.block.clear()
 
     def write_indexer_config(self):
         """Saves the current configuration as metadata."""
@@ -237,9 +1029,20 @@ class Indexer:
                 "rename_doc": self.rename_doc,
                 "file_location_step": self.file_location_step,
                 "block_threshold": self.block_threshold,
+                "block_memory": self.block_memory,
                 "merge_threshold": self.merge_threshold,
                 "merge_chunk_size": self.merge_chunk_size,
                 "merge_dir": self.merge_dir,
+                "workers": self.workers,
+                "read_ahead": self.read_ahead,
+                "index_format": self.index_format,
+                "int_doc_ids": self.int_doc_ids,
+                "posting_cache_size": self.posting_cache_size,
+                "query_time_bm25": self.query_time_bm25,
+                "merge_factor": self.merge_factor,
+                "posting_block_size": self.posting_block_size,
+                "generation": self.generation,
+                "generations": self.generations,
             }
             tokenizer = {
                 "min_length": self.tokenizer.min_length,
@@ -247,7 +1050,9 @@ class Indexer:
                 "no_numbers": self.tokenizer.no_numbers,
                 "stopwords_file": self.tokenizer.stopwords_file,
                 "contractions_file": self.tokenizer.contractions_file,
-                "stemmer": True if self.tokenizer.stemmer else False
+                "stemmer": True if self.tokenizer.stemmer else False,
+                "cache_size": self.tokenizer.cache_size,
+                "engine": self.tokenizer.engine
             }
             data = {"indexer": indexer, "tokenizer": tokenizer}
 
@@ -256,14 +1061,61 @@ class Indexer:
 
             json.dump(data, f, indent=2)
 
+    def read_generation(self):
+        """Reads the generation of the index in the index directory, or 0 if there is none."""
+
+        try:
+            with open(f"{self.merge_dir}.metadata/config.json", "r") as f:
+                return json.load(f).get("indexer", {}).get("generation", 0)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return 0
+
+    @staticmethod
+    def read_config_mtime(directory):
+        """Reads the modification time, in nanoseconds, of the config of an index directory, None if there is none."""
+
+        try:
+            return os.stat(f"{directory}.metadata/config.json").st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def reload(self):
+        """
+        Load the index of the directory again if another process wrote a newer generation of it, by indexing,
+        appending or merging documents. The config is only read when its modification time changes, so the
+        searches can check it before every query.
+
+        @return: the indexer of the newer generation, with the same posting lists budget and instrumentation,
+            or None if the generation in the directory is the same
+        """
+        config_mtime = Indexer.read_config_mtime(self.merge_dir)
+        if config_mtime is None or config_mtime == self.config_mtime:
+            return None
+
+        generation = self.read_generation()
+        if generation < self.generation:
+            # the config is being written, it is read again by the next check
+            return None
+        self.config_mtime = config_mtime
+        if generation == self.generation:
+            return None
+
+        indexer = Indexer.load_metadata(self.merge_dir)
+        indexer.set_posting_cache_size(self.posting_cache.max_size if self.posting_cache is not None else 0)
+        indexer.instrumentation = self.instrumentation
+        for index in indexer.generation_indexes:
+            index.instrumentation = self.instrumentation
+        return indexer
+
     def write_term_info_disk(self):
         """Saves term information as metadata."""
 
         logging.info("Writing # of postings for each term to disk")
+        self.sorted_terms = tuple(sorted(self.term_info))
         with open(self.merge_dir + ".metadata/term_info.txt", "w+") as f:
 
             # term idf file_location_step
-            for term in sorted(self.term_info):
+            for term in self.sorted_terms:
                 f.write(f"{term},{self.term_info[term].write()}\n")
 
     def read_term_info_memory(self):
@@ -277,6 +1129,95 @@ class Indexer:
                 term, _ = line.strip().split(',', 1)
                 self.term_info[term] = TermInfo.create(line)
 
+        # the terms are stored sorted, and the dict keeps them in the order they were read
+        self.sorted_terms = tuple(self.term_info)
+
+    def write_segments_disk(self):
+        """Saves the term range of every index file as metadata."""
+
+        logging.info("Writing index files term ranges to disk")
+        with open(f"{self.merge_dir}.metadata/segments.txt", "w") as f:
+            for first, last, filename in self.segments:
+                f.write(f"{first},{last},{os.path.relpath(filename, self.merge_dir)}\n")
+
+    def read_segments(self):
+        """Reads the term range of every index file from metadata."""
+
+        logging.info("Reading index files term ranges to memory")
+        if not os.path.exists(self.merge_dir):
+            logging.error("Index Directory does not exist. Cannot read posting lists.")
+            exit(1)
+
+        self.segments = []
+        try:
+            with open(f"{self.merge_dir}.metadata/segments.txt", "r") as f:
+                for line in f:
+                    first, last, filename = line.rstrip("\n").split(",", 2)
+                    self.segments.append((first, last, self.merge_dir + filename))
+        except FileNotFoundError:
+            # indexes created before the term ranges were saved
+            for filename in glob.glob(f"{self.merge_dir}*{self.segment_extension}*"):
+                first, last = self.__get_filename(filename).split(" ")
+                self.segments.append((first, last, filename))
+
+        self.segments.sort()
+        self.__segment_first_terms = [first for first, _, _ in self.segments]
+
+    def __get_term_segment(self, term):
+        """Get the index file whose term range contains the term."""
+
+        i = bisect.bisect_right(self.__segment_first_terms, term) - 1
+        if i >= 0 and term <= self.segments[i][1]:
+            return self.segments[i][2]
+        return None
+
+    def write_collection_stats(self):
+        """Saves the number of documents and their total length as metadata."""
+
+        with open(f"{self.merge_dir}.metadata/stats.json", "w") as f:
+            json.dump({"num_docs": self.__n_doc_indexed, "total_doc_len": self.__total_doc_lens}, f, indent=2)
+
+    def read_collection_stats(self):
+        """Reads the number of documents and their total length from metadata."""
+
+        with open(f"{self.merge_dir}.metadata/stats.json", "r") as f:
+            stats = json.load(f)
+        self.__n_doc_indexed = stats["num_docs"]
+        self.__total_doc_lens = stats["total_doc_len"]
+        return stats
+
+    def write_doc_lens(self):
+        """Saves the length of every document, in the order of their integer IDs, as metadata."""
+
+        doc_lens = np.fromiter((self.document_lens[doc_id] for doc_id in self.doc_ids), dtype=np.uint32,
+                               count=len(self.doc_ids))
+        np.save(f"{self.merge_dir}.metadata/doc_lens.npy", doc_lens)
+
+    def read_doc_lens(self):
+        """Reads the length of every document and the average document length from metadata."""
+
+        logging.info("Reading document lengths to memory")
+        self.doc_lens = np.load(f"{self.merge_dir}.metadata/doc_lens.npy")
+        stats = self.read_collection_stats()
+        self.avg_doc_len = stats["total_doc_len"] / stats["num_docs"]
+
+    def bm25_weights(self, idf, doc_ids, term_freqs, k1=None, b=None):
+        """
+        Calculate the BM25 weights of the postings of a term, as the indexer does for the index without
+        query-time BM25. Requires the document lengths.
+
+        @param idf: the idf of the term
+        @param doc_ids: the array of the integer document IDs of the postings
+        @param term_freqs: the array of the term frequencies of the postings
+        @param k1: the term frequency scaling, or None to use the one of the index
+        @param b: the document length normalization, or None to use the one of the index
+        @return: the array of the weights
+        """
+        k1 = self.ranking.k1 if k1 is None else k1
+        b = self.ranking.b if b is None else b
+        lengths = self.doc_lens[doc_ids] / self.avg_doc_len
+        return idf * (k1 + 1) * term_freqs / (k1 * ((1 - b) + b * lengths) + term_freqs)
+
     def write_doc_ids(self):
         """Saves the dict containing the new ids for the documents as metadata."""
 
@@ -304,7 +1245,7 @@ class Indexer:
                 self.doc_ids[doc_id] = doc
 
     def __get_filename(self, path):
-        return path.split("/")[-1].replace(".gz", "").split(".txt")[0]
+        return path.split("/")[-1].replace(".gz", "").split(self.segment_extension)[0]
 
     def __get_term_location(self, term):
         """
@@ -315,27 +1256,16 @@ class Indexer:
             return self.term_info[term].position
 
         # binary search
-        sorted_term_info = sorted(self.term_info.keys())
-
-        low = index = 0
-        high = len(sorted_term_info) - 1
-        while low <= high:
-            index = (high + low) // 2
-            if sorted_term_info[index] < term:
-                low = index + 1
-            elif sorted_term_info[index] > term:
-                high = index - 1
-            else:
-                break
+        index = bisect.bisect_left(self.sorted_terms, term)
 
         for i in range(self.file_location_step):
-            pos = self.term_info[sorted_term_info[index-i]].position
+            pos = self.term_info[self.sorted_terms[index-i]].position
             if pos:
                 # previous term has file location
                 return pos + i
 
-    def __get_term_postings_from_file(self, term, filename, skip=0):
-        """Get the term postings and weights from a index file."""
+    def __read_term_line(self, term, filename, skip=0):
+        """Get the postings of a term, as strings, from a text index file."""
 
         with self.open_merge_file(filename.replace(".gz", ""), "r") as f:
             for _ in range(skip):
@@ -346,53 +1276,444 @@ class Indexer:
                 term_r, *postings = line.strip().split(" ")
 
                 if term == term_r:
-                    weights = []
-                    docs = {}
-                    for post in postings:
-                        # post -> doc_id,weigth,pos1,pos2...
+                    self.instrumentation.count("posting_bytes", len(line))
+                    return postings
 
-                        # TODO: return pos
-                        doc_id, ws, *ps = post.split(",")
-                        weights.append(ws)
+    def __read_binary_term_record(self, term, filename, skip=0):
+        """Get the record of a term from a binary index file, and the offset of its postings in the record."""
 
-                        if self.rename_doc:                        
-                            docs[self.doc_ids[doc_id]] = ps
-                        else:
-                            docs[doc_id] = ps
+        with self.open_merge_file(filename.replace(".gz", ""), "rb") as f:
+            # every term record starts with its size, so the skipped ones are not decoded
+            for _ in range(skip):
+                f.seek(read_varint(f), os.SEEK_CUR)
 
-                    return weights, docs
+            while (size := read_varint(f)) is not None:
+                record = f.read(size)
 
-    def read_posting_lists(self, term):
-        """Reads the posting list of a term from disk."""
+                term_size, i = decode_varint(record)
+                if term == record[i:i + term_size].decode():
+                    self.instrumentation.count("posting_bytes", size)
+                    return record, i + term_size
 
-        if not os.path.exists(self.merge_dir):
-            logging.error("Index Directory does not exist. Cannot read posting lists.")
-            exit(1)
+    def __get_segment_map(self, filename):
+        """Get the memory map of an index file, mapping it the first time."""
+
+        if not (segment := self.__segment_maps.get(filename)):
+            with open(filename, "rb") as f:
+                segment = self.__segment_maps[filename] = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        return segment
+
+    def open_segments(self):
+        """Memory map every index file, so the searches do not open any file."""
+
+        if self.generation_indexes:
+            for index in self.generation_indexes:
+                index.open_segments()
+            return
+
+        if self.term_info and next(iter(self.term_info.values())).offset is None:
+            # the indexes created before the terms byte offsets were saved are not memory mapped
+            return
+
+        for _, _, filename in self.segments:
+            self.__get_segment_map(filename)
+
+    def __read_term_record_from_map(self, term, filename):
+        """Get the record of a term by slicing the memory mapped index file at the term location."""
+
+        segment = self.__get_segment_map(filename)
+        term_info = self.term_info[term]
+        if not filename.endswith(".gz"):
+            record = segment[term_info.offset:term_info.offset + term_info.length]
+            self.instrumentation.count("posting_bytes", term_info.length)
+        elif (start := term_info.group_offset) is None:
+            # the indexes created before the records were compressed in groups compress every record on its own
+            record = self.__read_record_group(segment, filename, term_info)
+        else:
+            group = self.__read_record_group(segment, filename, term_info)
+            if self.index_format == "binary":
+                size, i = decode_varint(group, start)
+                record = group[start:i + size]
+            else:
+                record = group[start:group.index(b"\n", start)]
+
+        if self.index_format == "binary":
+            _, i = decode_varint(record)
+            term_size, i = decode_varint(record, i)
+            return record, i + term_size
+
+        _, *postings = record.decode().strip().split(" ")
+        return postings
+
+    def __read_record_group(self, segment, filename, term_info):
+        """Get the decompressed group of records of a term, decompressing it if it is not cached."""
+
+        key = (filename, term_info.offset)
+        if (group := self.__group_cache.get(key)) is None:
+            compressed = segment[term_info.offset:term_info.offset + term_info.length]
+            group = zlib.decompressobj(-zlib.MAX_WBITS).decompress(compressed)
+            self.instrumentation.count("posting_bytes", term_info.length)
+            self.__group_cache.put(key, group)
+        return group
+
+    def __read_term_record(self, term, filename):
+        """
+        Get the record of a term from its index file.
+
+        @return: the postings of the term as strings for text indexes,
+            or the record and the offset of its postings for binary indexes
+        """
+        if self.term_info[term].offset is not None:
+            return self.__read_term_record_from_map(term, filename)
+
+        read_record = self.__read_binary_term_record if self.index_format == "binary" else self.__read_term_line
+        if self.file_location_step:
+            return read_record(term, filename, self.__get_term_location(term) - 1)
+        return read_record(term, filename)
+
+    def __parse_postings(self, postings):
+        """Get the weights and postings from the postings of a line of a index file."""
+
+        weights = []
+        docs = {}
+        for post in postings:
+            # post -> doc_id,weigth,pos1,pos2...
+
+            # TODO: return pos
+            doc_id, ws, *ps = post.split(",")
+            weights.append(ws)
+
+            if self.rename_doc:
+                docs[self.doc_ids[doc_id]] = ps
+            else:
+                docs[doc_id] = ps
+
+        return weights, docs
+
+    def __decode_binary_postings(self, record, i):
+        """
+        Decode the postings of a record of a binary index file, starting at offset `i`.
+
+        @return: the lists of the document IDs, the weights and the positions of the postings
+        """
+        n_postings, i = decode_varint(record, i)
+        *_, i = self.__decode_block_maxima(record, i, n_postings)
+        return self.__decode_binary_range(record, i, n_postings, 0)
+
+    def __decode_binary_range(self, record, i, n_postings, doc_id):
+        """
+        Decode `n_postings` postings of a record of a binary index file, starting at offset `i`
+        and after the document `doc_id`.
+
+        @return: the lists of the document IDs, the weights and the positions of the postings
+        """
+        doc_ids = []
+        weights = []
+        all_positions = []
+        for _ in range(n_postings):
+            # post -> doc gap,weight,#pos,pos gaps...
+            gap, i = decode_varint(record, i)
+            doc_id += gap
+            doc_ids.append(doc_id)
+            weights.append(PostingInfo.WEIGHT.unpack_from(record, i)[0])
+            i += PostingInfo.WEIGHT.size
+
+            ps = []
+            if self.positional:
+                n_positions, i = decode_varint(record, i)
+                pos = 0
+                for _ in range(n_positions):
+                    gap, i = decode_varint(record, i)
+                    pos += gap
+                    ps.append(pos)
+            all_positions.append(ps)
+
+        return doc_ids, weights, all_positions
+
+    def __decode_block_maxima(self, record, i, n_postings):
+        """
+        Decode the last document, the end of the postings and the highest weight of each block of a record
+        of a binary index file, starting at offset `i`. Only the records with more than one block have them.
+
+        @return: the lists of the last documents, the ends and the highest weights, and the offset of the postings
+        """
+        last_docs = []
+        ends = []
+        max_weights = []
+        if not self.posting_block_size or n_postings <= self.posting_block_size:
+            return last_docs, ends, max_weights, i
+
+        doc_id = end = 0
+        for _ in range(-(-n_postings // self.posting_block_size)):
+            # block -> last doc gap,postings bytes,max weight
+            gap, i = decode_varint(record, i)
+            size, i = decode_varint(record, i)
+            doc_id += gap
+            end += size
+            last_docs.append(doc_id)
+            ends.append(end)
+            max_weights.append(PostingInfo.WEIGHT.unpack_from(record, i)[0])
+            i += PostingInfo.WEIGHT.size
+
+        return last_docs, ends, max_weights, i
+
+    def __parse_binary_postings(self, record, i):
+        """Get the weights and postings from a record of a binary index file, starting at offset `i`."""
+
+        doc_ids, weights, positions = self.__decode_binary_postings(record, i)
+        docs = {self.doc_ids[str(doc_id)]: ps for doc_id, ps in zip(doc_ids, positions)}
+        return weights, docs
+
+    def __parse_posting_arrays(self, record):
+        """Get the integer document IDs and the weights of a term record as arrays."""
+
+        if self.index_format == "binary":
+            doc_ids, weights, _ = self.__decode_binary_postings(*record)
+        else:
+            doc_ids = []
+            weights = []
+            for post in record:
+                # post -> doc_id,weigth,pos1,pos2...
+                doc_id, ws, *_ = post.split(",", 2)
+                doc_ids.append(int(doc_id))
+                weights.append(float(ws or 0))
+
+        return np.array(doc_ids, dtype=np.int64), np.array(weights, dtype=np.float64)
+
+    @property
+    def posting_cache_size(self):
+        return self.posting_cache.max_size if self.posting_cache is not None else 0
+
+    def set_posting_cache_size(self, max_bytes):
+        """Set the memory budget, in bytes, of the posting lists cache. A budget of 0 disables it."""
+
+        # the size of the large posting lists is estimated from some of their postings
+        sizeof = functools.partial(get_object_size, samples=16)
+        self.posting_cache = LRUCache(max_bytes, sizeof) if max_bytes else None
+
+    @property
+    def matrix_dir(self):
+        return f"{self.merge_dir}.matrix/"
+
+    def export_matrix(self):
+        """
+        Export the weights of the index as a doc×term matrix, written to the ".matrix" directory of the index.
+        The rows are the documents, in the order they were indexed, and the columns are the terms, sorted.
+        """
+        logging.info("Exporting the index as a doc×term matrix")
+
+        doc_rows = {}
+        if self.rename_doc:
+            # the document aliases are stored in the order the documents were indexed
+            doc_rows = {doc: row for row, doc in enumerate(self.doc_ids.values())}
+
+        # every term is read once, so caching them would only evict the terms searched
+        posting_cache, self.posting_cache = self.posting_cache, None
+
+        rows, columns, data = [], [], []
+        for column, term in enumerate(self.sorted_terms):
+            if self.int_doc_ids:
+                # the integer document IDs are already the rows
+                if not (term_info := self.read_posting_arrays(term)):
+                    continue
+                idf, doc_ids, weights = term_info
+                if self.query_time_bm25:
+                    weights = self.bm25_weights(idf, doc_ids, weights)
+                rows.append(doc_ids)
+                data.append(weights.astype(np.float32))
+            else:
+                if not (term_info := self.read_posting_lists(term)):
+                    continue
+                _, weights, postings = term_info
+                rows.append(np.fromiter((doc_rows.setdefault(doc, len(doc_rows)) for doc in postings),
+                                        dtype=np.int64, count=len(postings)))
+                data.append(np.fromiter((float(w or 0) for w in weights), dtype=np.float32, count=len(weights)))
+            columns.append(np.full(len(rows[-1]), column, dtype=np.int32))
+
+        self.posting_cache = posting_cache
+
+        rows = np.concatenate(rows) if rows else np.empty(0, dtype=np.int64)
+        columns = np.concatenate(columns) if columns else np.empty(0, dtype=np.int32)
+        data = np.concatenate(data) if data else np.empty(0, dtype=np.float32)
+
+        # sorts the entries by row and then by column
+        order = np.lexsort((columns, rows))
+        indptr = np.zeros(len(doc_rows) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(rows, minlength=len(doc_rows)), out=indptr[1:])
+
+        matrix = DocTermMatrix(indptr, columns[order], data[order], list(doc_rows), list(self.sorted_terms))
+        matrix.save(self.matrix_dir)
+        logging.info(f"Matrix with {matrix.shape[0]} documents, {matrix.shape[1]} terms "
+                     f"and {matrix.nnz} weights written to disk")
+        return matrix
+
+    def load_matrix(self):
+        """Load the doc×term matrix of the index, exporting it first if it does not exist."""
+
+        if not os.path.exists(f"{self.matrix_dir}indptr.npy"):
+            return self.export_matrix()
+
+        logging.info("Reading doc×term matrix to memory")
+        return DocTermMatrix.load(self.matrix_dir)
+
+    def close(self):
+        """Close the memory maps of the index files."""
 
+        for segment in self.__segment_maps.values():
+            segment.close()
+        self.__segment_maps.clear()
+        for index in self.generation_indexes:
+            index.close()
+
+    def read_posting_lists(self, term):
+        """
+        Reads the posting list of a term from disk.
+        The posting lists are cached, so they must not be modified.
+        """
+        if self.posting_cache is not None and (cached := self.posting_cache.get((term, "lists"))):
+            return cached
+        if self.generation_indexes:
+            return self.__read_generation_postings(term, arrays=False)
+
+        instrumentation = self.instrumentation
         # search for file
-        files = glob.glob(f"{self.merge_dir}/*.txt*")
-        term_file = None
-        for f in files:
-            f_terms = self.__get_filename(f).split(" ")
-            if f_terms[0] <= term <= f_terms[1]:
-                term_file = f
-                break
+        with instrumentation.phase("segment_routing"):
+            term_file = self.__get_term_segment(term)
 
         # search position on file
-        if term_file != None and term in self.term_info:
-            idf = self.term_info[term].idf
-            if self.file_location_step:
-                term_location = self.__get_term_location(term)
-                weights, postings = self.__get_term_postings_from_file(
-                    term, term_file, term_location - 1)
-            else:
-                weights, postings = self.__get_term_postings_from_file(
-                    term, term_file)
+        with instrumentation.phase("lexicon_lookup"):
+            term_info = self.term_info.get(term)
+        if term_file != None and term_info is not None:
+            idf = term_info.idf
+            with instrumentation.phase("posting_io"):
+                record = self.__read_term_record(term, term_file)
+
+            with instrumentation.phase("parse_postings"):
+                if self.index_format == "binary":
+                    weights, postings = self.__parse_binary_postings(*record)
+                else:
+                    weights, postings = self.__parse_postings(record)
+
+            if self.posting_cache is not None:
+                self.posting_cache.put((term, "lists"), (idf, weights, postings))
             return idf, weights, postings
 
         logging.warning(f"Ignoring term \"{term}\"")
         return None
 
+    def read_posting_arrays(self, term):
+        """
+        Reads the posting list of a term from disk as arrays, without mapping the document IDs.
+        Requires integer document IDs.
+
+        @return: the idf of the term, and the arrays of the document IDs and the weights of its postings
+        """
+        if self.posting_cache is not None and (cached := self.posting_cache.get((term, "arrays"))):
+            return cached
+        if self.generation_indexes:
+            return self.__read_generation_postings(term, arrays=True)
+
+        instrumentation = self.instrumentation
+        with instrumentation.phase("segment_routing"):
+            term_file = self.__get_term_segment(term)
+
+        with instrumentation.phase("lexicon_lookup"):
+            term_info = self.term_info.get(term)
+        if term_file != None and term_info is not None:
+            with instrumentation.phase("posting_io"):
+                record = self.__read_term_record(term, term_file)
+            with instrumentation.phase("parse_postings"):
+                doc_ids, weights = self.__parse_posting_arrays(record)
+
+            if self.posting_cache is not None:
+                # the cached arrays are shared by the searches
+                doc_ids.flags.writeable = weights.flags.writeable = False
+                self.posting_cache.put((term, "arrays"), (term_info.idf, doc_ids, weights))
+            return term_info.idf, doc_ids, weights
+
+        logging.warning(f"Ignoring term \"{term}\"")
+        return None
+
+    def read_posting_blocks(self, term, posting_arrays=None):
+        """
+        Reads the posting list of a term from disk as PostingBlocks, whose blocks are decoded when searched.
+        Requires integer document IDs.
+        The records of the binary index store the last document and the highest weight of each block,
+        the other posting lists are read as arrays and split in blocks.
+
+        @param posting_arrays: the posting arrays of the term, if already read
+        @return: the idf of the term and its PostingBlocks
+        """
+        block_size = self.posting_block_size or POSTING_BLOCK_SIZE
+        if (posting_arrays or self.index_format != "binary" or not self.posting_block_size or self.generation_indexes
+                or (self.posting_cache is not None and (term, "arrays") in self.posting_cache)):
+            if not (term_info := posting_arrays or self.read_posting_arrays(term)):
+                return None
+            idf, doc_ids, weights = term_info
+            return idf, PostingBlocks.from_arrays(doc_ids, weights, block_size)
+
+        if self.posting_cache is None or not (cached := self.posting_cache.get((term, "blocks"))):
+            instrumentation = self.instrumentation
+            with instrumentation.phase("segment_routing"):
+                term_file = self.__get_term_segment(term)
+
+            with instrumentation.phase("lexicon_lookup"):
+                term_info = self.term_info.get(term)
+            if term_file == None or term_info is None:
+                logging.warning(f"Ignoring term \"{term}\"")
+                return None
+
+            with instrumentation.phase("posting_io"):
+                record, i = self.__read_term_record(term, term_file)
+            with instrumentation.phase("parse_postings"):
+                n_postings, i = decode_varint(record, i)
+                last_docs, ends, max_weights, i = self.__decode_block_maxima(record, i, n_postings)
+            if not last_docs:
+                # the posting lists of a single block have no block maxima, so they are read at once
+                return self.read_posting_blocks(term, self.read_posting_arrays(term))
+
+            cached = (term_info.idf, bytes(record[i:]), n_postings, ends,
+                      np.array(last_docs, dtype=np.int64), np.array(max_weights, dtype=np.float64))
+            if self.posting_cache is not None:
+                self.posting_cache.put((term, "blocks"), cached)
+
+        idf, postings, n_postings, ends, last_docs, max_weights = cached
+
+        def decode_block(k):
+            if self.posting_cache is not None and (cached := self.posting_cache.get((term, "block", k))):
+                return cached
+            with self.instrumentation.phase("parse_postings"):
+                doc_ids, weights, _ = self.__decode_binary_range(
+                    postings, ends[k - 1] if k else 0, min(block_size, n_postings - k * block_size),
+                    int(last_docs[k - 1]) if k else 0)
+            doc_ids, weights = np.array(doc_ids, dtype=np.int64), np.array(weights, dtype=np.float64)
+
+            if self.posting_cache is not None:
+                # the cached arrays are shared by the searches
+                doc_ids.flags.writeable = weights.flags.writeable = False
+                self.posting_cache.put((term, "block", k), (doc_ids, weights))
+            return doc_ids, weights
+
+        return idf, PostingBlocks(last_docs, max_weights, decode_block)
+
+    def read_posting_lists_batch(self, terms, arrays=False):
+        """
+        Reads the posting lists of many terms, each one once.
+        The index files are split by term ranges and store the terms sorted,
+        so the terms are read grouped by index file and in the order they are stored.
+
+        @param terms: the terms to read
+        @param arrays: read the posting lists as arrays, as `read_posting_arrays` does
+        @return: a dict with the posting lists of each term in the index
+        """
+        read_posting_lists = self.read_posting_arrays if arrays else self.read_posting_lists
+
+        postings = {}
+        for term in sorted(set(terms)):
+            if term in self.term_info and (term_postings := read_posting_lists(term)):
+                postings[term] = term_postings
+        return postings
+
     def clear_blocks(self):
         """Remove blocks folder."""
 
@@ -414,19 +1735,15 @@ class Indexer:
         os.rmdir(block_dir)
 
     def open_file_to_index(self, filename):
-        """Open and return the dataset file."""
+        """Open and return the dataset file, as text or gzip according to its first bytes."""
         try:
-            f = open(filename, "r")
-            f.readline()  # skip header
-            return f
-        except:
-            pass
+            with open(filename, "rb") as f:
+                magic = f.read(2)
 
-        try:
-            f = gzip.open(filename, "rt")
+            f = gzip.open(filename, "rt") if magic == GZIP_MAGIC else open(filename, "r")
             f.readline()  # skip header
             return f
-        except gzip.BadGzipFile:
+        except (OSError, UnicodeDecodeError, EOFError):
             pass
 
         logging.error("Could not open the provided file")
@@ -439,11 +1756,16 @@ class Indexer:
             filename += ".gz"
 
         if filename.endswith(".gz"):
-            return gzip.open(filename, mode + "t")
+            return gzip.open(filename, mode if "b" in mode else mode + "t")
         return open(filename, mode)
 
     def merge_block_disk(self):
-        """Merge all blocks in disk."""
+        """
+        Merge all blocks in disk.
+        The blocks are merged with a k-way merge and each term is written as soon as
+        its postings from every block are read, so only a chunk of each block is in memory.
+        With multiple workers, the terms are split in ranges that are merged in parallel.
+        """
 
         logging.info("Merging blocks from disk")
         if not os.path.exists(self.merge_dir):
@@ -451,98 +1773,81 @@ class Indexer:
         if not os.path.exists(f"{self.merge_dir}.metadata/"):
             os.mkdir(f"{self.merge_dir}.metadata/")
 
-        # opens every block file and stores the file pointers in a list
-        blocks = [open(block, "r")
-                  for block in glob.glob(f"{self.merge_dir}block/*")]
-        terms = {}
-        
-        last_terms = [None for _ in range(len(blocks))] # last term for every block
-        last_term = None                                # min last term
-
-        curr = 0
-        while blocks or terms:
-            b = 0
-            while b != len(blocks):
-                # check if the last_term is the same as the last_term for the block
-                if last_term == last_terms[b]:
-                    f = blocks[b]
-                    chunk = f.readlines(self.merge_chunk_size)
-                    # if the file ends it needs to be removed from the lists
-                    if not chunk:
-                        f.close()
-                        del blocks[b]
-                        del last_terms[b]
-                        continue
+        # the blocks are merged in the order they were written, so the postings keep the documents order
+        block_files = sorted(glob.glob(f"{self.merge_dir}block/block*.txt"),
+                             key=lambda block: int(os.path.basename(block)[5:-4]))
 
-                    for term_postings in chunk:
-                        term, *postings = term_postings.strip().split(' ')
-
-                        postings_str = ""
-                        for i in range(len(postings)):
-                            postings[i] = PostingInfo.create(postings[i], self.positional)
-                            if self.ranking.name == "BM25":
-                                # bm25 weights are calculated before being written to disk
-                                # this way they are not kept in memory for long and can
-                                # free space whenever they are written
-                                
-                                # vsm weights were written to the blocks and now only the chunks
-                                # are loaded into memory, so they are in memory for a short time aswell
-                                
-                                postings[i].weight = self.__calculate_ci(
-                                    term, postings[i].doc_id, postings[i].term_freq)
-                            postings[i].term_freq = None
-                            postings_str += f" {postings[i].write_to_index()}"
-                        curr += i
-
-                        terms.setdefault(term, ["", 0])
-                        terms[term][0] += postings_str
-                        terms[term][1] += i
-                    last_terms[b] = term
-                b += 1
-
-            # last_term is only updated if the list is not empty
-            last_term = min(last_terms) if last_terms else last_term
-
-            # checks if the current number of posts in the dict is at least higher than the threshold
-            # if not there is no need to run the following code
-            if curr < self.merge_threshold and blocks:
-                continue
-
-            # checks which terms can be written to disk and calculates the size of their posting lists
-            total = 0
-            sorted_terms = sorted(terms)
-            for term in sorted_terms:
-                if term >= last_term:
-                    break
-                total += terms[term][1]
-                if total >= self.merge_threshold:
-                    break
+        ranges = [(None, None)]
+        if self.workers > 1 and block_files:
+            ranges = self.__split_term_ranges(self.workers)
 
-            if total >= self.merge_threshold:
-                # write when the total terms postings exceed a threshold
-                curr -= total
-                self.__store_term_merged_file(terms, sorted_terms, term, True)
-            elif not blocks:
-                # write the left terms in the last block
-                self.__store_term_merged_file(terms, sorted_terms, term)
+        merger = self.__block_merger()
+        if len(ranges) == 1:
+            results = [merger.merge_block_range(block_files)]
+        else:
+            logging.info(f"Merging {len(ranges)} term ranges with {len(ranges)} workers")
+            with Pool(len(ranges), _init_merge_worker, (merger,)) as pool:
+                results = pool.starmap(_merge_block_range, [
+                    (block_files, first, last, f"segment{i}.tmp") for i, (first, last) in enumerate(ranges)])
+
+        # the ranges are sorted, so are the index files of every worker
+        for term_locations, segments in results:
+            for term, *location in term_locations:
+                term_info = self.term_info[term]
+                (term_info.position, term_info.offset, term_info.length, term_info.group_offset,
+                 term_info.max_weight) = location
+            for segment in segments:
+                self.segments.append(segment)
+                self.__segment_first_terms.append(segment[0])
+            # the blocks written before merging are counted as "blocks"
+            self.instrumentation.count("segments", len(segments))
 
         self.clear_blocks()
 
-    def __store_term_merged_file(self, terms, sorted_terms, last_term, threshold_term=False):
-        """Write the terms in memory to an index file."""
+    def __block_merger(self):
+        """Create the merger of the blocks, with the document lengths and the idf only for precomputed BM25."""
+
+        bm25 = {}
+        if not self.query_time_bm25 and self.ranking is not None and self.ranking.name == "BM25":
+            bm25 = {"idf": {term: term_info.idf for term, term_info in self.term_info.items()},
+                    "document_lens": self.document_lens,
+                    "avg_doc_len": self.__total_doc_lens / self.__n_doc_indexed}
+        return BlockMerger(self.merge_dir, self.index_format, self.positional, self.save_zip, self.merge_threshold,
+                           self.merge_chunk_size, self.file_location_step, self.posting_block_size,
+                           self.query_time_bm25, self.ranking, **bm25)
 
-        logging.info(f"Writing index \"{sorted_terms[0]} {last_term}\" to disk")     
-        with self.open_merge_file(f"{self.merge_dir}{sorted_terms[0]} {last_term}.txt") as f:
-            for ti, t in enumerate(sorted_terms):
-                if not threshold_term or t <= last_term:
-                    f.write(f"{t}{terms[t][0]}\n")
-                    if self.file_location_step and ti % self.file_location_step == 0:
-                        self.term_info[t].position = ti + 1
-                    del terms[t]
+    def __split_term_ranges(self, n_ranges):
+        """
+        Split the terms in ranges of similar number of postings. The ranges start at terms where a serial merge
+        starts a new index file, known from the number of postings of every term, so the index files written
+        by each range are the same as the ones of a serial merge.
+        """
+        starts = []         # [(first term of an index file, postings of the previous index files)]
+        total = postings = 0
+        for term in sorted(self.term_info):
+            if not postings:
+                starts.append((term, total))
+            postings += self.term_info[term].posting_size
+            total += self.term_info[term].posting_size
+            if postings >= self.merge_threshold:
+                postings = 0
+
+        splits = []
+        for i in range(1, n_ranges):
+            target = total * i // n_ranges
+            k = bisect.bisect_left(starts, target, key=lambda start: start[1])
+            if 0 < k < len(starts) and starts[k][0] not in splits:
+                splits.append(starts[k][0])
+        return list(zip([None] + splits, splits + [None]))
 
     def __next_doc_id(self):
         """Get the next alias for the document ID"""
 
+        if self.int_doc_ids:
+            # the documents are numbered in the order they are indexed, after the ones of the previous generations
+            self.__last_rename = str(int(self.__last_rename) + 1) if self.__last_rename else "0"
+            return self.__last_rename
+
         # range of alias' alphabet in the ascii table
         max_char = 126
         min_char = 48
@@ -564,59 +1869,28 @@ class Indexer:
         self.__last_rename = "".join(doc_id)
         return self.__last_rename
 
-    def __calculate_ranking_info(self, terms, doc):
-        """Calculate the ranking info"""
+    def __calculate_ranking_info(self, terms, doc, stats=None):
+        """Calculate the ranking info, the term frequency and weight (VSM only) of each term of the document."""
 
         if not self.ranking:
-            return
-
-        terms_cnt = {}
-        for term, pos in terms:
-            terms_cnt.setdefault(term, 0)
-            terms_cnt[term] += 1
-
-        if self.ranking.name == "VSM":
-            # calculates weights depending on the schema provided
-            # stores term frequency to be used on the blocks
+            return None
 
-            cos_norm = 0
+        if stats is None:
+            stats = term_statistics(terms, self.ranking)
 
-            for term in terms_cnt:
-                self.term_doc_weights.setdefault(term, {})
-                self.term_frequency.setdefault(term, {})
-
-                cnt = terms_cnt[term]
-                self.term_frequency[term][doc] = cnt
-                if self.ranking.p1[0] == "l":
-                    # l**
-                    self.term_doc_weights[term][doc] = 1 + math.log10(cnt)
-                elif self.ranking.p1[0] == "n":
-                    # n**
-                    self.term_doc_weights[term][doc] = cnt
-
-                cos_norm += self.term_doc_weights[term][doc]**2
-
-            if self.ranking.p1[2] == "c":
-                # **c
-                cos_norm = 1 / math.sqrt(cos_norm)
-                for term in terms_cnt:
-                    self.term_doc_weights[term][doc] *= cos_norm
-
-        elif self.ranking.name == "BM25":
-            # stores the information of the document lengths and the term frequency for each term-doc
+        if self.ranking.name == "BM25":
+            # stores the information of the document lengths
             self.document_lens[doc] = len(terms)
-            self.__total_doc_lens += len(terms)
 
-            for term in terms_cnt:
-                self.term_frequency.setdefault(term, {})
-                self.term_frequency[term][doc] = terms_cnt[term]
+        return stats
 
-    def index_terms(self, terms, doc):
+    def index_terms(self, terms, doc, stats=None):
         """
         Index a list of terms provided by the tokenizer.
 
         @param terms: the list of terms
         @param doc: the document ID
+        @param stats: the ranking info of the document, if already calculated
         """
         # indexes a list of terms provided by the tokenizer
 
@@ -625,20 +1899,11 @@ class Indexer:
             self.doc_ids[self.__last_rename] = doc
             doc = self.__last_rename
 
-        self.__calculate_ranking_info(terms, doc)
+        stats = self.__calculate_ranking_info(terms, doc, stats)
+        self.__total_doc_lens += len(terms)
 
         # terms -> List[Tuple(term, pos)]
-        for term, pos in terms:
-            if self.positional:
-                # index -> Dict[term: Dict[doc: List[pos]]]
-                self.index.setdefault(term, {doc: []}) \
-                    .setdefault(doc, []) \
-                    .append(pos)
-            else:
-                # index -> Dict[term: List[doc]]
-                self.index.setdefault(term, set()) \
-                    .add(doc)
-        self.__post_cnt += len(terms)
+        self.block.add(doc, terms, stats)
 
     def index_file(self, filename):
         """
@@ -646,33 +1911,345 @@ class Indexer:
 
         @param filename: the dataset filename
         """
-        with self.open_file_to_index(filename) as f:
-            while f:
-                line = f.readline()
+        instrumentation = self.instrumentation
+        with instrumentation.span("index", filename=filename):
+            with self.open_file_to_index(filename) as f, \
+                    BatchReader(f, self.worker_batch_size, self.read_ahead) as batches:
+                if self.workers > 1:
+                    documents = self.__tokenize_parallel(batches)
+                else:
+                    documents = (self.tokenizer.tokenize(line) + (None,)
+                                 for line in itertools.chain.from_iterable(batches))
+
+                for terms, doc, stats in instrumentation.iterate("tokenize", documents):
+                    # writes block to disk when there are more postings than the threshold, or it uses too much memory
+                    if self.block.n_tokens >= self.block_threshold or self.block.size >= self.block_memory:
+                        with instrumentation.phase("write_block_disk"):
+                            self.write_block_disk()
+                        instrumentation.count("blocks")
+
+                    if not terms:
+                        continue
 
-                # writes block to disk when there are more postings than the threshold
-                # or when the file ends
-                if not line or self.__post_cnt >= self.block_threshold:
+                    with instrumentation.phase("index_terms"):
+                        self.index_terms(terms, doc, stats)
+                    self.__n_doc_indexed += 1
+                    instrumentation.count("documents")
+                    instrumentation.count("tokens", len(terms))
+
+                # writes the last block when the file ends
+                with instrumentation.phase("write_block_disk"):
                     self.write_block_disk()
-                if not line:
-                    break
+                instrumentation.count("blocks")
 
-                terms, doc = self.tokenizer.tokenize(line)
+            # the index replaces the one in the directory, if any, with the generations appended to it
+            self.generations = []
+            self.__write_index()
 
-                if not terms:
-                    continue
+        for directory in glob.glob(f"{self.merge_dir}generation*/"):
+            shutil.rmtree(directory)
+        if os.path.exists(self.matrix_dir):
+            # the matrix of a previous index is exported again when needed
+            shutil.rmtree(self.matrix_dir)
+
+    def __write_index(self):
+        """Merge the blocks written to disk into the index files and write the metadata of the index."""
+
+        instrumentation = self.instrumentation
+        if self.ranking:
+            with instrumentation.phase("calculate_idf"):
+                self.__calculate_idf()
+
+        self.generation = self.read_generation() + 1
+        with instrumentation.phase("merge_block_disk"):
+            self.merge_block_disk()
+        with instrumentation.phase("write_term_info"):
+            self.write_term_info_disk()
+        with instrumentation.phase("write_segments"):
+            self.write_segments_disk()
+        if self.rename_doc:
+            with instrumentation.phase("write_doc_ids"):
+                self.write_doc_ids()
+        self.write_collection_stats()
+        if self.query_time_bm25:
+            with instrumentation.phase("write_doc_lens"):
+                self.write_doc_lens()
+        with instrumentation.phase("write_config"):
+            self.write_indexer_config()
+
+    def append_file(self, filename):
+        """
+        Index the documents of a dataset as a new generation of the index, without indexing the documents already
+        in it again. The generation is an index of its own, in a subdirectory of the index directory, and becomes
+        part of the index when the config lists it. The generations are then merged by the tiered merge policy.
+        Requires an index loaded with `load_metadata`.
+
+        @param filename: the dataset filename
+        """
+        if self.ranking and self.ranking.name == "BM25" and not self.query_time_bm25:
+            logging.error("The BM25 weights stored in the index depend on every document. "
+                          "Cannot append documents to an index without query-time BM25.")
+            exit(1)
+        if self.term_info and not next(iter(self.term_info.values())).posting_size:
+            logging.error("The index does not store the document frequency of the terms. "
+                          "Cannot append documents to it.")
+            exit(1)
+        if not os.path.exists(f"{self.merge_dir}.metadata/stats.json"):
+            logging.error("The index does not store the number of documents. Cannot append documents to it.")
+            exit(1)
 
-                self.index_terms(terms, doc)
-                self.__n_doc_indexed += 1
+        instrumentation = self.instrumentation
+        with instrumentation.span("append", filename=filename):
+            name = f"generation{self.read_generation() + 1}"
+            index = self.__new_generation(name)
+            if self.rename_doc:
+                # the documents are renamed after the ones already indexed
+                index.__last_rename = next(reversed(self.doc_ids), "")
+            index.index_file(filename)
+
+            if not index.__n_doc_indexed:
+                logging.warning("The dataset has no documents to append")
+                shutil.rmtree(index.merge_dir)
+                return
+
+            self.generation = self.read_generation() + 1
+            self.generations.append(name)
+            with instrumentation.phase("write_config"):
+                self.write_indexer_config()
+            self.close()
+            self.load_generations()
+            instrumentation.count("generations")
+
+            self.tiered_merge()
+
+        if os.path.exists(self.matrix_dir):
+            shutil.rmtree(self.matrix_dir)
+
+    def __new_generation(self, name):
+        """Create the indexer of a new generation, with the configurations of the index."""
+
+        index = Indexer.read_config(f"{self.merge_dir}.metadata/config.json")
+        index.merge_dir = f"{self.merge_dir}{name}/"
+        index.generations = []
+        index.instrumentation = self.instrumentation
+        return index
+
+    def __load_generation(self, directory):
+        """Load the index of a generation, whose posting lists are cached and timed by this indexer."""
+
+        index = Indexer.read_config(f"{directory}.metadata/config.json")
+        index.merge_dir = directory
+        index.generations = []
+        index.read_term_info_memory()
+        index.read_segments()
+        if index.rename_doc:
+            index.read_doc_ids()
+        index.read_collection_stats()
+        index.set_posting_cache_size(0)
+        index.instrumentation = self.instrumentation
+        return index
+
+    def load_generations(self):
+        """
+        Load the index of the directory and of every generation appended to it, and combine their metadata.
+        The collection stats and the document frequency of the terms are added up, and the idf of the terms
+        is calculated again with them.
+        """
+        logging.info(f"Reading {len(self.generations) + 1} generations of the index")
+        self.generation_indexes = [self.__load_generation(self.merge_dir)] + [
+            self.__load_generation(f"{self.merge_dir}{name}/") for name in self.generations]
 
+        self.term_info = {}
+        for index in self.generation_indexes:
+            for term, term_info in index.term_info.items():
+                if (total := self.term_info.get(term)) is None:
+                    total = self.term_info[term] = TermInfo(max_weight=0)
+                total.posting_size += term_info.posting_size
+                total.max_weight = max(total.max_weight, term_info.max_weight or 0)
+        self.sorted_terms = tuple(sorted(self.term_info))
+
+        self.__n_doc_indexed = sum(index.__n_doc_indexed for index in self.generation_indexes)
+        self.__total_doc_lens = sum(index.__total_doc_lens for index in self.generation_indexes)
         if self.ranking:
-            self.__calculate_idf()
+            for term_info in self.term_info.values():
+                term_info.idf = math.log10(self.__n_doc_indexed / term_info.posting_size)
+
+        self.segments = [segment for index in self.generation_indexes for segment in index.segments]
+        if self.rename_doc:
+            self.doc_ids = {}
+            for index in self.generation_indexes:
+                self.doc_ids.update(index.doc_ids)
+                # the generations map the document IDs of their postings with the ones of the whole index
+                index.doc_ids = self.doc_ids
+        if self.query_time_bm25:
+            self.doc_lens = np.concatenate([np.load(f"{index.merge_dir}.metadata/doc_lens.npy")
+                                            for index in self.generation_indexes])
+            self.avg_doc_len = self.__total_doc_lens / self.__n_doc_indexed
+
+        # the posting lists cached are the ones of the previous generations
+        self.set_posting_cache_size(self.posting_cache_size)
+
+    def __read_generation_postings(self, term, arrays):
+        """
+        Reads the posting list of a term from every generation of the index that has it.
+        The generations are read in the order they were indexed, so the postings keep the documents order.
+        """
+        if (term_info := self.term_info.get(term)) is None:
+            logging.warning(f"Ignoring term \"{term}\"")
+            return None
+
+        parts = []
+        for index in self.generation_indexes:
+            if term in index.term_info and (part := (index.read_posting_arrays(term) if arrays
+                                                     else index.read_posting_lists(term))):
+                parts.append(part)
+
+        if arrays:
+            doc_ids = np.concatenate([doc_ids for _, doc_ids, _ in parts])
+            weights = np.concatenate([weights for _, _, weights in parts])
+            term_postings = (term_info.idf, doc_ids, weights)
+        else:
+            weights, postings = [], {}
+            for _, term_weights, term_postings in parts:
+                weights.extend(term_weights)
+                postings.update(term_postings)
+            term_postings = (term_info.idf, weights, postings)
+
+        if self.posting_cache is not None:
+            if arrays:
+                # the cached arrays are shared by the searches
+                doc_ids.flags.writeable = weights.flags.writeable = False
+            self.posting_cache.put((term, "arrays" if arrays else "lists"), term_postings)
+        return term_postings
+
+    def tiered_merge(self, merge_factor=None):
+        """
+        Merge the generations appended to the index with a tiered policy, so their number stays bounded.
+        The generations are grouped in tiers by their number of documents, a tier for each power of the merge
+        factor, and every `merge_factor` consecutive generations of the same tier are merged into one, usually
+        of the next tier. The index of the directory is never merged.
+
+        @param merge_factor: the number of generations of a tier that are merged, or None to use the one of the index
+        @return: the number of merges
+        """
+        # a single generation would be merged with itself forever
+        merge_factor = max(merge_factor or self.merge_factor, 2)
+
+        merges = 0
+        while True:
+            tiers = []
+            for index in self.generation_indexes[1:]:
+                n_docs, tier = index.__n_doc_indexed, 0
+                while n_docs >= merge_factor:
+                    n_docs //= merge_factor
+                    tier += 1
+                tiers.append(tier)
+
+            for first in range(len(tiers) - merge_factor + 1):
+                if len(set(tiers[first:first + merge_factor])) == 1:
+                    break
+            else:
+                return merges
+
+            # the index of the directory is the first one
+            self.merge_generations(first + 1, first + 1 + merge_factor)
+            merges += 1
+
+    def merge_generations(self, first=1, last=None):
+        """
+        Merge consecutive generations appended to the index into a new one.
+        The postings of every generation are written as a block of the new one, and the blocks are merged
+        as the ones of an indexing, so the postings keep the documents order.
+
+        @param first: the position of the first generation merged, the index of the directory is in position 0
+        @param last: the position after the last generation merged, or None to merge up to the last one
+        """
+        first = max(first, 1)
+        last = len(self.generation_indexes) if last is None else last
+        merged = self.generation_indexes[first:last]
+        if len(merged) < 2:
+            return
+
+        instrumentation = self.instrumentation
+        with instrumentation.span("merge"):
+            name = f"generation{self.read_generation() + 1}"
+            logging.info(f"Merging {len(merged)} generations into {name}")
+            index = self.__new_generation(name)
+            os.makedirs(f"{index.merge_dir}block/")
+            with instrumentation.phase("write_block_disk"):
+                for generation in merged:
+                    index.__write_generation_block(generation)
+            index.__write_index()
+
+            self.generation = self.read_generation() + 1
+            replaced = self.generations[first - 1:last - 1]
+            self.generations[first - 1:last - 1] = [name]
+            with instrumentation.phase("write_config"):
+                self.write_indexer_config()
+
+            self.close()
+            for generation in replaced:
+                shutil.rmtree(f"{self.merge_dir}{generation}/")
+            self.load_generations()
+            instrumentation.count("generation_merges")
+
+    def __write_generation_block(self, generation):
+        """Write the postings of a generation as a block of this indexer, and add its documents to it."""
+
+        with open(f"{self.merge_dir}block/block{self.__block_cnt}.txt", "w") as f:
+            self.__block_cnt += 1
+            for term in generation.sorted_terms:
+                postings = generation.__block_postings(term)
+                f.write(f"{term} {' '.join(postings)}\n")
+                self.term_info.setdefault(term, TermInfo()).posting_size += len(postings)
 
-        self.merge_block_disk()
-        self.write_term_info_disk()
         if self.rename_doc:
-            self.write_doc_ids()
-        self.write_indexer_config()
+            # the generation shares the document IDs of the whole index
+            generation.read_doc_ids()
+            self.doc_ids.update(generation.doc_ids)
+        if self.query_time_bm25:
+            doc_lens = np.load(f"{generation.merge_dir}.metadata/doc_lens.npy")
+            self.document_lens.update(zip(generation.doc_ids, doc_lens.tolist()))
+        self.__n_doc_indexed += generation.__n_doc_indexed
+        self.__total_doc_lens += generation.__total_doc_lens
+
+    def __block_postings(self, term):
+        """Get the postings of a term, read from its index file, as they are written to the blocks."""
+
+        record = self.__read_term_record(term, self.__get_term_segment(term))
+        if self.index_format == "binary":
+            # the weights are written with all their digits, so they are stored again as they are
+            postings = [(str(doc_id), repr(weight), ",".join(map(str, positions)))
+                        for doc_id, weight, positions in zip(*self.__decode_binary_postings(*record))]
+        else:
+            postings = [post.split(",", 2) + [""] for post in record]
+
+        block = []
+        for doc, w, pos, *_ in postings:
+            # doc,w,pos -> doc,w,tf,pos
+            tf = ""
+            if self.query_time_bm25:
+                # the weights of the index are the term frequencies
+                w, tf = "", str(int(float(w)))
+            block.append(f"{doc},{w},{tf},{pos}" if self.positional else f"{doc},{w},{tf}")
+        return block
+
+    def __tokenize_parallel(self, batches):
+        """
+        Tokenize batches of lines of a file in a pool of processes.
+        The documents are yielded in the same order as they appear in the file.
+        """
+        logging.info(f"Tokenizing with {self.workers} workers")
+
+        with Pool(self.workers, _init_tokenize_worker, (self.tokenizer, self.ranking)) as pool:
+            # limits the batches in flight so the file is not read to memory at once
+            pending = deque()
+            for batch in batches:
+                pending.append(pool.apply_async(_tokenize_lines, (batch,)))
+                if len(pending) >= 2 * self.workers:
+                    yield from pending.popleft().get()
+            while pending:
+                yield from pending.popleft().get()
 
     def __calculate_idf(self):
         """Calculate inverse document frequency for each term."""
@@ -681,15 +2258,3 @@ class Indexer:
             document_frequency = self.term_info[term].posting_size
             idf = math.log10(self.__n_doc_indexed / document_frequency)
             self.term_info[term].idf = idf
-
-    def __calculate_ci(self, term, doc, term_frequency):
-        """Calculate BM25 weights for each term-doc."""
-
-        avdl = self.__total_doc_lens / self.__n_doc_indexed
-        idf = self.term_info[term].idf
-        document_len = self.document_lens[doc]
-
-        ci = idf * (self.ranking.k1 + 1) * term_frequency / (self.ranking.k1 *
-            ((1 - self.ranking.b) + self.ranking.b * document_len/avdl) + term_frequency)
-
-        return ci
@@ -0,0 +1,176 @@
+# Bruno Bastos 93302
+# Leandro Silva 93446
+
+import json
+import time
+from contextlib import contextmanager
+
+
+class PhaseStats():
+    """Number of times a phase ran, and the total and maximum time it took, in seconds."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def add(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def to_dict(self):
+        return {"count": self.count, "total": self.total, "max": self.max}
+
+
+class Instrumentation():
+    """
+    Collects the time taken by the phases of the indexing and the searches, and counters of what they did.
+
+    The time of a phase does not include the time of the phases timed inside it, so the phases of a run add up
+    to the time of the run. The phases and counters of a span, such as a query, are also passed to every hook
+    when the span ends, as a dict:
+        {"span": "query", "labels": {...}, "time": seconds, "phases": {phase: seconds}, "counters": {name: value}}
+    """
+
+    def __init__(self):
+        self.phases = {}            # {phase: PhaseStats}
+        self.counters = {}          # {name: value}
+        self.hooks = []             # functions called with each span when it ends
+
+        self.__nested = []          # time of the phases timed inside each phase being timed
+        self.__span = None          # phases and counters of the span being instrumented
+
+    def add_hook(self, hook):
+        """
+        Call `hook` with the phases and counters of every span when it ends.
+
+        @param hook: a function with the span dict as its only argument
+        """
+        self.hooks.append(hook)
+
+    def remove_hook(self, hook):
+        self.hooks.remove(hook)
+
+    @contextmanager
+    def phase(self, name):
+        """Time the code run inside the context as the phase `name`."""
+
+        self.__nested.append(0)
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            nested = self.__nested.pop()
+            if self.__nested:
+                self.__nested[-1] += elapsed
+            self.record(name, elapsed - nested)
+
+    def iterate(self, name, iterable):
+        """Iterate over `iterable`, timing the time taken to produce each item as the phase `name`."""
+
+        iterator = iter(iterable)
+        while True:
+            with self.phase(name):
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    return
+            yield item
+
+    def record(self, name, seconds):
+        """Add the time taken by a run of the phase `name`."""
+
+        if (stats := self.phases.get(name)) is None:
+            stats = self.phases[name] = PhaseStats()
+        stats.add(seconds)
+
+        if self.__span is not None:
+            phases = self.__span["phases"]
+            phases[name] = phases.get(name, 0) + seconds
+
+    def count(self, name, value=1):
+        """Add `value` to the counter `name`."""
+
+        self.counters[name] = self.counters.get(name, 0) + value
+
+        if self.__span is not None:
+            counters = self.__span["counters"]
+            counters[name] = counters.get(name, 0) + value
+
+    @contextmanager
+    def span(self, name, **labels):
+        """
+        Collect the phases and counters of the code run inside the context, and pass them to the hooks.
+        A span inside another one is part of the outer span.
+        """
+        if self.__span is not None:
+            yield
+            return
+
+        self.__span = {"span": name, "labels": labels, "time": 0, "phases": {}, "counters": {}}
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            span, self.__span = self.__span, None
+            span["time"] = time.perf_counter() - start
+            for hook in self.hooks:
+                hook(span)
+
+    def reset(self):
+        self.phases.clear()
+        self.counters.clear()
+
+    def to_dict(self):
+        return {
+            "phases": {name: stats.to_dict() for name, stats in self.phases.items()},
+            "counters": dict(self.counters),
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=2)
+
+    def to_prometheus(self, prefix="ri"):
+        """Get the phases and counters in the Prometheus text exposition format."""
+
+        lines = []
+
+        def metric(name, kind, help, samples):
+            lines.append(f"# HELP {prefix}_{name} {help}")
+            lines.append(f"# TYPE {prefix}_{name} {kind}")
+            lines.extend(f"{prefix}_{name}{labels} {value}" for labels, value in samples)
+
+        phases = sorted(self.phases.items())
+        if phases:
+            metric("phase_seconds_total", "counter", "Time spent in each phase.",
+                   [(f'{{phase="{name}"}}', stats.total) for name, stats in phases])
+            metric("phase_runs_total", "counter", "Number of times each phase ran.",
+                   [(f'{{phase="{name}"}}', stats.count) for name, stats in phases])
+            metric("phase_max_seconds", "gauge", "Longest time a run of each phase took.",
+                   [(f'{{phase="{name}"}}', stats.max) for name, stats in phases])
+
+        for name, value in sorted(self.counters.items()):
+            metric(f"{name}_total", "counter", f"Total {name.replace('_', ' ')}.", [("", value)])
+
+        return "\n".join(lines) + "\n"
+
+    def write(self, filename, format="json"):
+        """Write the phases and counters to a file as JSON or in the Prometheus text format."""
+
+        with open(filename, "w") as f:
+            f.write(self.to_prometheus() if format == "prometheus" else self.to_json())
+
+
+class JSONLinesHook():
+    """Hook that writes every span to a file as a line of JSON."""
+
+    def __init__(self, filename):
+        self.file = open(filename, "w")
+
+    def __call__(self, span):
+        self.file.write(json.dumps(span) + "\n")
+
+    def close(self):
+        self.file.close()
@@ -3,12 +3,18 @@
 
 import os
 import sys
+import asyncio
 import logging
 import coloredlogs
 import argparse
+import cProfile
+import pstats
 from tokenizer import Tokenizer
 from indexer import Indexer
-from query import Query
+from query import Query, BM25, VSM
+from server import SearchServer
+from instrumentation import JSONLinesHook
+from utils import convert_size
 import time
 
 logger = logging.getLogger(__name__)
@@ -26,25 +32,118 @@ def create_indexer(args):
     else:
         args_dict = vars(args)
         tokenizer = Tokenizer(**args_dict)
-        indexer = Indexer(tokenizer=tokenizer, **args_dict)
+        ranking = BM25(**args_dict) if args.name == "BM25" else VSM(**args_dict)
+        indexer = Indexer(tokenizer=tokenizer, ranking=ranking, **args_dict)
 
+    trace = start_trace(indexer, args)
     start = time.perf_counter()
     indexer.index_file(args.index)
     logging.info(
         f"Finished indexing ({time.perf_counter() - start:.2f} seconds)")
+    for phase, stats in indexer.instrumentation.phases.items():
+        logging.info(f"  {phase}: {stats.total:.2f} seconds")
     logging.info(f"Vocabulary size: {indexer.vocabulary_size}")
     logging.info(f"Index size on disk: {indexer.disk_size}")
     logging.info(f"Index segments written to disk: {indexer.num_segments}")
+    if (cache := indexer.tokenizer.cache) is not None and cache.hits + cache.misses:
+        logging.info(f"Tokenizer cache: {cache.hits} hits, {cache.misses} misses "
+                     f"({cache.hit_ratio:.2%} hit ratio)")
+
+    if args.export_matrix:
+        start = time.perf_counter()
+        indexer.export_matrix()
+        logging.info(
+            f"Finished exporting the doc×term matrix ({time.perf_counter() - start:.2f} seconds)")
+
+    write_metrics(indexer, args, trace)
+
+
+def append_indexer(args):
+    start = time.perf_counter()
+    indexer = Indexer.load_metadata(args.directory)
+    if args.merge_factor is not None:
+        indexer.merge_factor = args.merge_factor
+    logging.info(
+        f"Time taken to start up index: {time.perf_counter() - start:.2f} seconds")
+
+    trace = start_trace(indexer, args)
+    start = time.perf_counter()
+    indexer.append_file(args.append)
+    logging.info(
+        f"Finished appending ({time.perf_counter() - start:.2f} seconds)")
+    for phase, stats in indexer.instrumentation.phases.items():
+        logging.info(f"  {phase}: {stats.total:.2f} seconds")
+    logging.info(f"Documents in the index: {indexer.num_docs}")
+    logging.info(f"Vocabulary size: {indexer.vocabulary_size}")
+    logging.info(f"Index generations: {len(indexer.generation_indexes)}")
+    logging.info(f"Index size on disk: {indexer.disk_size}")
+
+    write_metrics(indexer, args, trace)
+
+
+def merge_indexer(args):
+    indexer = Indexer.load_metadata(args.merge)
+    if args.merge_factor is not None:
+        indexer.merge_factor = args.merge_factor
+    if not indexer.generations:
+        logging.info("The index has no generations appended to merge")
+        return
+
+    start = time.perf_counter()
+    generations = len(indexer.generations)
+    if args.all:
+        indexer.merge_generations()
+    else:
+        indexer.tiered_merge()
+    logging.info(
+        f"Finished merging ({time.perf_counter() - start:.2f} seconds)")
+    logging.info(f"Generations appended to the index: {generations} -> {len(indexer.generations)}")
+
+
+def start_trace(indexer, args):
+    """Write the phases of every query or indexing to the trace file, if requested."""
+
+    if not args.trace:
+        return None
+    trace = JSONLinesHook(args.trace)
+    indexer.instrumentation.add_hook(trace)
+    return trace
+
+
+def write_metrics(indexer, args, trace=None):
+    """Write the time of each phase and the counters of the run to the metrics file, if requested."""
+
+    if trace:
+        trace.close()
+    if args.metrics:
+        indexer.instrumentation.write(args.metrics, args.metrics_format)
+        logging.info(f"Metrics written to {args.metrics}")
 
 
 def search_indexer(args):
     start = time.perf_counter()
     indexer = Indexer.load_metadata(args.search)
+    if args.posting_cache_size is not None:
+        indexer.set_posting_cache_size(args.posting_cache_size)
 
     logging.info(
         f"Time taken to start up index: {time.perf_counter() - start:.2f} seconds")
 
-    query = Query(indexer, args.boost)
+    trace = start_trace(indexer, args)
+
+    matrix = None
+    if args.matrix:
+        start = time.perf_counter()
+        matrix = indexer.load_matrix()
+        logging.info(
+            f"Time taken to load the doc×term matrix: {time.perf_counter() - start:.2f} seconds")
+
+    try:
+        query = Query(indexer, args.boost, args.wand, matrix, args.result_cache_size, args.result_cache_ttl,
+                      args.batch, args.boost_mode, args.bm25_k1, args.bm25_b)
+    except ValueError as e:
+        logging.error(e)
+        exit(1)
 
     if args.test:
         query.search_file_with_accuracy("queries.relevance.txt")
@@ -72,11 +171,36 @@ def search_indexer(args):
                 logging.info(
                     f"Your search - {search} - did not match any documents")
 
+    # the index is loaded again when another process writes a new generation of it
+    if (cache := query.indexer.posting_cache) is not None and cache.hits + cache.misses:
+        logging.info(f"Posting lists cache: {cache.hits} hits, {cache.misses} misses "
+                     f"({cache.hit_ratio:.2%} hit ratio), {cache.evictions} evictions, "
+                     f"{convert_size(cache.size)} of {convert_size(cache.max_size)} in use")
+    if (cache := query.cache) is not None and cache.hits + cache.misses:
+        logging.info(f"Results cache: {cache.hits} hits, {cache.misses} misses "
+                     f"({cache.hit_ratio:.2%} hit ratio), {cache.evictions} evictions, "
+                     f"{cache.expirations} expirations")
+
+    write_metrics(indexer, args, trace)
+
+
+def serve_indexer(args):
+    server = SearchServer(args.serve, args.port, args.workers, args.max_concurrency, args.posting_cache_size,
+                          boost_window=args.boost, boost_mode=args.boost_mode, dynamic_pruning=args.wand,
+                          k1=args.bm25_k1, b=args.bm25_b,
+                          cache_size=args.result_cache_size, cache_ttl=args.result_cache_ttl)
+    try:
+        asyncio.run(server.serve())
+    except KeyboardInterrupt:
+        pass
+
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(
         description='Document indexer using the SPIMI approach')
+    parser.add_argument('--profile', metavar='FILE',
+                        help='profile the run with cProfile and save the statistics to FILE')
 
     subparser = parser.add_subparsers(
         title='mode argument', dest='mode', required=True, help='mode of the program')
@@ -100,12 +224,36 @@ if __name__ == "__main__":
                         help='store file location for terms step by step (const: %(const)s, default: %(default)s)')
     group1.add_argument('--block-threshold', metavar='THRESHOLD', type=int, default=1_000_000,
                         help='maximum number of documents that can be stored in a block (default: %(default)s)')
+    group1.add_argument('--block-memory', metavar='BYTES', type=int, default=256 * 1024**2,
+                        help='estimated memory a block can use before it is written to disk (default: %(default)s)')
     group1.add_argument('--merge-threshold', metavar='THRESHOLD', type=int, default=1_000_000,
                         help='maximum number of documents that can be stored in a index (default: %(default)s)')
     group1.add_argument('--merge-chunk-size', metavar='SIZE', type=int, default=1000,
                         help='size of the block chunks read (default: %(default)s)')
     group1.add_argument('--merge-dir', metavar='DIR', default="indexer/",
                         help='source directory path to store the indexer (default: %(default)s)')
+    group1.add_argument('--workers', metavar='N', type=int, default=1,
+                        help='number of processes used to tokenize the documents and merge the blocks '
+                        '(default: %(default)s)')
+    group1.add_argument('--read-ahead', metavar='N', type=int, default=8,
+                        help='number of batches of lines of the dataset read ahead by a background thread, '
+                        '0 to read them in the main thread (default: %(default)s)')
+    group1.add_argument('--index-format', choices=['text', 'binary'], default="text",
+                        help='format of the index segments written to disk (default: %(default)s)')
+    group1.add_argument('--int-doc-ids', action='store_true',
+                        help='number the documents in the order they are indexed and score the queries in arrays '
+                        '(implied by the binary format)')
+    group1.add_argument('--posting-cache-size', metavar='BYTES', type=int, default=64 * 1024**2,
+                        help='memory budget of the cache of posting lists read by the searches, 0 to disable it '
+                        '(default: %(default)s)')
+    group1.add_argument('--query-time-bm25', action='store_true',
+                        help='store the term frequencies and document lengths instead of the BM25 weights, so the '
+                        'searches can change k1 and b (implies --int-doc-ids)')
+    group1.add_argument('--merge-factor', metavar='N', type=int, default=10,
+                        help='number of generations of documents appended of the same tier that are merged into one '
+                        '(default: %(default)s)')
+    group1.add_argument('--export-matrix', action='store_true',
+                        help='export the weights of the index as a doc×term matrix after indexing')
 
     group2 = d_parser.add_argument_group('tokenizer optional arguments')
     group2.add_argument('--case-folding', action='store_true',
@@ -120,9 +268,14 @@ if __name__ == "__main__":
                         help='remove tokens from a stopwords file (default: %(default)s)')
     group2.add_argument('--contractions-file', metavar='FILE', default="../data/en_contractions.txt",
                         help='replace tokens from a contractions file (default: %(default)s)')
+    group2.add_argument('--cache-size', metavar='SIZE', type=int, default=100_000,
+                        help='maximum number of tokens kept in the normalization cache, 0 to disable it '
+                        '(default: %(default)s)')
+    group2.add_argument('--engine', choices=['default', 'fast'], default="default",
+                        help='the implementation used to normalize the tokens (default: %(default)s)')
 
     group3 = d_parser.add_argument_group('ranking optional arguments')
-    group3.add_argument('-n, --name', choices=['VSM', 'BM25'], default="BM25",
+    group3.add_argument('-n', '--name', choices=['VSM', 'BM25'], default="BM25",
                         help='the type of ranking (default: %(default)s)')
     group3.add_argument('-p1', metavar='SCHEME', type=str, default="lnc",
                         help='document scheme (default: %(default)s)')
@@ -133,6 +286,16 @@ if __name__ == "__main__":
     group3.add_argument('-b', metavar='N', type=float, default=1,
                         help='document length normalization (default: %(default)s)')
 
+    a_parser = subparser.add_parser('append',
+                                    help='index new documents as a new generation of an indexer already created')
+    a_parser.add_argument('append', metavar='FILE',
+                          help='file with the documents to append')
+    a_parser.add_argument('directory', metavar='DIR',
+                          help='source directory of an indexer')
+    a_parser.add_argument('--merge-factor', metavar='N', type=int,
+                          help='number of generations of the same tier that are merged into one '
+                          '(default: the one of the indexer config)')
+
     i_parser = subparser.add_parser('search',
                                     help='search in an indexer already created')
     i_parser.add_argument('search', metavar='DIR',
@@ -140,15 +303,119 @@ if __name__ == "__main__":
     i_parser.add_argument('-b', '--boost', metavar='WINDOW', type=int, nargs='?', default=0, const=5,
                           help='boost query results with a function that ranks according to document windows of '
                           'size WINDOW (const: %(const)s, default: %(default)s)')
+    i_parser.add_argument('--boost-mode', choices=['proximity', 'reference'], default="proximity",
+                          help='the boost function, the minimal windows of the query terms or the original '
+                          'sliding windows (default: %(default)s)')
+    i_parser.add_argument('--wand', action='store_true',
+                          help='skip the documents that cannot be in the top results '
+                          '(BM25 with integer document IDs and without boost only)')
+    i_parser.add_argument('--posting-cache-size', metavar='BYTES', type=int,
+                          help='memory budget of the cache of posting lists, 0 to disable it '
+                          '(default: the one of the indexer config)')
+    i_parser.add_argument('--result-cache-size', metavar='SIZE', type=int, default=1000,
+                          help='maximum number of query results kept in the cache, 0 to disable it '
+                          '(default: %(default)s)')
+    i_parser.add_argument('--result-cache-ttl', metavar='SECONDS', type=float,
+                          help='seconds the results are kept in the cache (default: until they are evicted)')
+    i_parser.add_argument('--batch', action='store_true',
+                          help='read the posting lists of all the queries of a file once, before scoring them')
+    i_parser.add_argument('--bm25-k1', metavar='N', type=float,
+                          help='term frequency scaling of an index with query-time BM25 (default: the one of the index)')
+    i_parser.add_argument('--bm25-b', metavar='N', type=float,
+                          help='document length normalization of an index with query-time BM25 '
+                          '(default: the one of the index)')
+    i_parser.add_argument('--matrix', action='store_true',
+                          help='score the queries of a file in batches with the doc×term matrix of the index, '
+                          'exporting it if needed (without boost only)')
+    for mode_parser in (d_parser, a_parser, i_parser):
+        m_group = mode_parser.add_argument_group('instrumentation optional arguments')
+        m_group.add_argument('--metrics', metavar='FILE',
+                             help='write the time of each phase and the counters of the run to FILE')
+        m_group.add_argument('--metrics-format', choices=['json', 'prometheus'], default="json",
+                             help='format of the metrics file (default: %(default)s)')
+        m_group.add_argument('--trace', metavar='FILE',
+                             help='write the phases and counters of every query, or of the indexing, to FILE '
+                             'as JSON lines')
+
     i_group = i_parser.add_mutually_exclusive_group()
     i_group.add_argument('-q', '--query', metavar='FILE',
                          help='text file with multiple queries separated by a new line')
     i_group.add_argument('-t', '--test', action='store_true',
                          help='test results accuracy comparing with scores from \"queries.relevance.txt\"')
 
+    g_parser = subparser.add_parser('merge',
+                                    help='merge the generations appended to an indexer with the tiered merge policy')
+    g_parser.add_argument('merge', metavar='DIR',
+                          help='source directory of an indexer')
+    g_parser.add_argument('--merge-factor', metavar='N', type=int,
+                          help='number of generations of the same tier that are merged into one '
+                          '(default: the one of the indexer config)')
+    g_parser.add_argument('--all', action='store_true',
+                          help='merge every generation appended into one')
+
+    s_parser = subparser.add_parser('serve',
+                                    help='serve the searches of an indexer already created as a JSON HTTP endpoint '
+                                    'on localhost')
+    s_parser.add_argument('serve', metavar='DIR',
+                          help='source directory of an indexer')
+    s_parser.add_argument('--port', metavar='PORT', type=int, default=8000,
+                          help='port of the server (default: %(default)s)')
+    s_parser.add_argument('--workers', metavar='N', type=int, default=1,
+                          help='number of processes that score the queries (default: %(default)s)')
+    s_parser.add_argument('--max-concurrency', metavar='N', type=int, default=8,
+                          help='maximum number of queries searched at the same time, the other ones wait '
+                          '(default: %(default)s)')
+    s_parser.add_argument('-b', '--boost', metavar='WINDOW', type=int, nargs='?', default=0, const=5,
+                          help='boost query results with a function that ranks according to document windows of '
+                          'size WINDOW (const: %(const)s, default: %(default)s)')
+    s_parser.add_argument('--boost-mode', choices=['proximity', 'reference'], default="proximity",
+                          help='the boost function, the minimal windows of the query terms or the original '
+                          'sliding windows (default: %(default)s)')
+    s_parser.add_argument('--wand', action='store_true',
+                          help='skip the documents that cannot be in the top results '
+                          '(BM25 with integer document IDs and without boost only)')
+    s_parser.add_argument('--bm25-k1', metavar='N', type=float,
+                          help='term frequency scaling of an index with query-time BM25, the requests can change it '
+                          '(default: the one of the index)')
+    s_parser.add_argument('--bm25-b', metavar='N', type=float,
+                          help='document length normalization of an index with query-time BM25, the requests can '
+                          'change it (default: the one of the index)')
+    s_parser.add_argument('--posting-cache-size', metavar='BYTES', type=int,
+                          help='memory budget of the cache of posting lists of each worker, 0 to disable it '
+                          '(default: the one of the indexer config)')
+    s_parser.add_argument('--result-cache-size', metavar='SIZE', type=int, default=1000,
+                          help='maximum number of query results kept in the cache of each worker, 0 to disable it '
+                          '(default: %(default)s)')
+    s_parser.add_argument('--result-cache-ttl', metavar='SECONDS', type=float,
+                          help='seconds the results are kept in the cache (default: until they are evicted)')
+
     args = parser.parse_args()
 
-    if args.mode == 'index':
-        create_indexer(args)
-    elif args.mode == 'search':
-        search_indexer(args)
+    if args.mode == 'index' and not 0 <= args.b <= 1:
+        parser.error("-b must be in [0, 1]")
+    if args.mode == 'search' and args.matrix and args.boost:
+        parser.error("--matrix cannot be used with --boost")
+    if args.mode == 'search' and args.matrix and (args.bm25_k1 is not None or args.bm25_b is not None):
+        parser.error("--matrix cannot be used with --bm25-k1 or --bm25-b")
+
+    if args.profile:
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    try:
+        if args.mode == 'index':
+            create_indexer(args)
+        elif args.mode == 'append':
+            append_indexer(args)
+        elif args.mode == 'merge':
+            merge_indexer(args)
+        elif args.mode == 'search':
+            search_indexer(args)
+        elif args.mode == 'serve':
+            serve_indexer(args)
+    finally:
+        if args.profile:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            logging.info(f"Profile written to {args.profile}, the functions that took the most time:")
+            pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)
@@ -1,6 +1,7 @@
 # Bruno Bastos 93302
 # Leandro Silva 93446
 
+import heapq
 import math
 import logging
 import os
@@ -8,7 +9,7 @@ from random import random
 import time
 
 from tabulate import tabulate
-from utils import levenshtein
+from utils import levenshtein, LRUCache
 import numpy as np
 from typing import List, Union
 
@@ -48,34 +49,152 @@ class BM25(Ranking):
         super().__init__("BM25", k1, b)
 
 
+# margin added to the upper bounds of the weights, which are rounded when written to disk
+WAND_EPSILON = 1e-6
+
+
 class Query:
 
-    def __init__(self, indexer, boost_window=0):
+    def __init__(self, indexer, boost_window=0, dynamic_pruning=False, matrix=None, cache_size=0, cache_ttl=None,
+                 batch=False, boost_mode="proximity", k1=None, b=None):
         self.indexer = indexer
+        self.instrumentation = indexer.instrumentation
         self.boost_window = boost_window
+        # "proximity" boosts with `proximity_boost`, "reference" with the original `boost_query`
+        self.boost_mode = boost_mode
+        # BM25 parameters of the searches of an index with query-time BM25, None to use the ones of the index
+        self.k1 = k1
+        self.b = b
+        self.check_bm25_parameters(indexer.query_time_bm25, k1, b)
+
+        if indexer.query_time_bm25 and (boost_window or dynamic_pruning):
+            # the weights are only calculated when scoring in arrays
+            logging.warning("Boost and WAND are not available with query-time BM25. Ignoring them.")
+            boost_window = dynamic_pruning = False
+            self.boost_window = 0
+        if dynamic_pruning and not indexer.int_doc_ids:
+            # the postings are only stored by document order with integer document IDs
+            logging.warning("WAND requires integer document IDs. Ignoring it.")
+            dynamic_pruning = False
+        self.dynamic_pruning = dynamic_pruning
+        # doc×term matrix used to score the queries of a file in batches
+        self.matrix = matrix
+        self.batch_size = 64
+
+        # reads the posting lists of all queries of a file before scoring them
+        self.batch = batch
+        self.batch_postings = None      # {term: posting lists} read for the queries being searched
+
+        # results of the queries searched the most recently, valid while the index generation is the same
+        self.cache = LRUCache(cache_size, ttl=cache_ttl) if cache_size else None
+
+        # score accumulators of the indexes with integer document IDs, reset after every query
+        self.scores = self.matched = None
+        self.__reset_accumulators()
+
+    def __reset_accumulators(self):
+        """Allocate the score accumulators for the documents of the index, if it has integer document IDs."""
+        if self.indexer.int_doc_ids:
+            self.scores = np.zeros(self.indexer.num_docs)
+            self.matched = np.zeros(self.indexer.num_docs, dtype=bool)
+
+    def reload_index(self):
+        """
+        Search the newer generation of the index if another process wrote it to the index directory since the
+        index was loaded, and clear the results cached from the previous one.
+        """
+        try:
+            indexer = self.indexer.reload()
+        except (OSError, ValueError, KeyError) as e:
+            # the files of the new generation are still being written, they are loaded by the next check
+            logging.warning(f"Cannot load the new generation of the index yet: {e}")
+            return
+        if indexer is None:
+            return
+
+        logging.info(f"Index directory changed, searching generation {indexer.generation}")
+        self.indexer.close()
+        self.indexer = indexer
+        self.__reset_accumulators()
+        if self.cache is not None:
+            self.cache.clear()
+        if self.matrix is not None:
+            self.matrix = indexer.load_matrix()
 
     def search_file(self, filename):
 
         with open(filename, "r") as f:
-            with open(f"./results.txt", "w") as q:
-                for i, line in enumerate(f):
-                    line = line.strip()
+            queries = [line.strip() for line in f]
 
-                    start = time.perf_counter()
-                    results = self.search(line)
+        start = time.perf_counter()
+        all_results = self.search_all(queries)
+        logging.info(
+            f"{time.perf_counter() - start:.2f} sec to search for {len(queries)} queries")
 
-                    logging.info(
-                        f"{time.perf_counter() - start:.2f} sec to search for \"{line}\"")
+        with open(f"./results.txt", "w") as q:
+            for line, results in zip(queries, all_results):
+                q.write(f"Q: {line}\n\n")
+                if not results:
+                    q.write(
+                        "Your search - {line} - did not match any documents\n")
+                    continue
 
-                    q.write(f"Q: {line}\n\n")
-                    if not results:
-                        q.write(
-                            "Your search - {line} - did not match any documents\n")
-                        continue
+                for doc, score in results:
+                    q.write(f"{doc}\t{score:.6f}\n")
+                q.write("\n")
+
+    def search_all(self, queries, top=10):
+        """Search a list of queries and return the results of each one, in the same order."""
+
+        self.reload_index()
+        if self.matrix is not None:
+            return self.search_matrix(queries, top)
+        if self.batch:
+            return self.__search_shared(queries, top)
+        return [self.__timed_search(query, top) for query in queries]
 
-                    for doc, score in results:
-                        q.write(f"{doc}\t{score:.6f}\n")
-                    q.write("\n")
+    def __timed_search(self, query, top=10):
+        """Search a query and log the time it took."""
+
+        start = time.perf_counter()
+        results = self.search(query, top)
+
+        logging.info(
+            f"{time.perf_counter() - start:.2f} sec to search for \"{query}\"")
+        return results
+
+    def __search_shared(self, queries, top=10):
+        """
+        Search a list of queries reading the posting list of each distinct term only once.
+        The terms of all queries are read first, in the order they are stored in the index files,
+        and then every query is scored from the posting lists read.
+        """
+        start = time.perf_counter()
+        all_terms = [self.indexer.tokenizer.normalize_tokens(query.strip().split()) for query in queries]
+
+        terms = {term for query_terms in all_terms for term in query_terms}
+        self.batch_postings = self.indexer.read_posting_lists_batch(terms, arrays=self.uses_arrays)
+        logging.info(f"{time.perf_counter() - start:.2f} sec to read the posting lists of "
+                     f"{len(self.batch_postings)} terms for {len(queries)} queries")
+
+        all_results = []
+        latencies = []
+        try:
+            for query, query_terms in zip(queries, all_terms):
+                query_start = time.perf_counter()
+                all_results.append(self.search_terms(query_terms, top) if query_terms else None)
+                latencies.append(time.perf_counter() - query_start)
+
+                logging.info(
+                    f"{1000 * latencies[-1]:.2f} ms to search for \"{query}\"")
+        finally:
+            self.batch_postings = None
+
+        if latencies:
+            p50, p95 = np.percentile(latencies, [50, 95])
+            logging.info(f"Query latency: {1000 * p50:.2f} ms p50, {1000 * p95:.2f} ms p95, "
+                         f"{1000 * max(latencies):.2f} ms max")
+        return all_results
 
     def search_file_with_accuracy(self, filename):
 
@@ -84,22 +203,25 @@ class Query:
                   "F-Measure", "Average Precision", "NDCG"]
 
         start = time.perf_counter()
-        queries = 0
+        relevances = []
         with open(filename, "r") as f:
 
             for line in f:
                 if line.startswith("Q:"):
-                    queries += 1
                     query = line[2:].strip()
                     docs = []
                     while (line := f.readline().strip()):
                         temp = line.split()
                         docs.append((temp[0], int(temp[1])))
+                    relevances.append((query, docs))
 
-                    data = self.metrics(docs, self.search(query, top=50))
-                    all_data.append(data)
+        all_results = self.search_all([query for query, _ in relevances], top=50)
+
+        for (_, docs), results in zip(relevances, all_results):
+            all_data.append(self.metrics(docs, results))
 
         total_time = time.perf_counter() - start
+        queries = len(relevances)
 
         logging.info(
             f"Query Throughput: {queries / total_time:.2f} queries/second")
@@ -117,26 +239,234 @@ class Query:
         print(tabulate([header, *avg_data],
               headers="firstrow", floatfmt='.3f'))
 
-    def search(self, query, top=10):
-
-        terms = self.indexer.tokenizer.normalize_tokens(query.strip().split())
-
-        if not terms:
-            return None
+    def search(self, query, top=10, k1=None, b=None):
+
+        self.reload_index()
+        with self.instrumentation.span("query", query=query):
+            with self.instrumentation.phase("tokenize_query"):
+                terms = self.indexer.tokenizer.normalize_tokens(query.strip().split())
+
+            if not terms:
+                return None
+
+            return self.search_terms(terms, top, k1, b)
+
+    @staticmethod
+    def check_bm25_parameters(query_time_bm25, k1=None, b=None):
+        """
+        Raise a ValueError if the BM25 parameters cannot be used to search an index.
+
+        @param query_time_bm25: whether the index has query-time BM25
+        """
+        if k1 is None and b is None:
+            return
+        if not query_time_bm25:
+            raise ValueError("k1 and b can only be changed in indexes with query-time BM25")
+        # NaN fails every comparison and an infinite k1 is not negative, but both give weights that are not numbers
+        if k1 is not None and not math.isfinite(k1):
+            raise ValueError("The term frequency scaling, k1, must be a finite number")
+        if b is not None and not math.isfinite(b):
+            raise ValueError("The document length normalization, b, must be a finite number")
+        if k1 is not None and k1 < 0:
+            raise ValueError("The term frequency scaling, k1, must not be negative")
+        if b is not None and not 0 <= b <= 1:
+            raise ValueError("The document length normalization, b, must be in [0, 1]")
+
+    def search_terms(self, terms: List[str], top=10, k1=None, b=None):
+        """
+        Search the normalized terms of a query, using the results cache if enabled.
+
+        @param k1: the BM25 term frequency scaling of an index with query-time BM25,
+            None to use the one of the query
+        @param b: the BM25 document length normalization of an index with query-time BM25,
+            None to use the one of the query
+        """
+        self.check_bm25_parameters(self.indexer.query_time_bm25, k1, b)
+        k1 = self.k1 if k1 is None else k1
+        b = self.b if b is None else b
+
+        with self.instrumentation.span("query", query=" ".join(terms)):
+            self.instrumentation.count("queries")
+
+            if self.cache is None:
+                return self.__timed_score(terms, top, k1, b)
+
+            # the order of the terms only matters to the boost
+            key = (tuple(terms) if self.boost_window else tuple(sorted(terms)), top, self.boost_window,
+                   self.boost_mode, k1, b)
+            if (results := self.cache.get(key)) is None:
+                results = self.__timed_score(terms, top, k1, b)
+                self.cache.put(key, results)
+            else:
+                self.instrumentation.count("result_cache_hits")
+            return list(results)
+
+    def __timed_score(self, terms: List[str], top=10, k1=None, b=None):
+        """Score the terms of a query, timing the scoring apart from the reading of the posting lists."""
+
+        with self.instrumentation.phase("score"):
+            return self.score(terms, top, k1, b)
+
+    def score(self, terms: List[str], top=10, k1=None, b=None):
+        """Score and rank the documents for the terms of a query, according to the ranking of the index."""
+
+        if self.indexer.ranking.name == "BM25" and self.dynamic_pruning and not self.boost_window:
+            return self.bm25_max_score(terms, top)
+        if self.uses_arrays:
+            return self.array_score(terms, top, k1, b)
 
         if self.indexer.ranking.name == "VSM":
-            return self.tf_idf_score(terms)[:top]
+            return self.tf_idf_score(terms, top)
         elif self.indexer.ranking.name == "BM25":
-            return self.bm25_score(terms)[:top]
+            return self.bm25_score(terms, top)
+
+    @property
+    def uses_arrays(self):
+        """Whether the searches read the posting lists as arrays."""
+        return self.indexer.int_doc_ids and not self.boost_window
+
+    def read_posting_lists(self, term):
+        """Read the posting lists of a term, from the ones already read for the queries being searched if there."""
+
+        if self.batch_postings is not None and term in self.batch_postings:
+            return self.batch_postings[term]
+        return self.indexer.read_posting_lists(term)
+
+    def read_posting_arrays(self, term):
+        """Read the posting arrays of a term, from the ones already read for the queries being searched if there."""
+
+        if self.batch_postings is not None and term in self.batch_postings:
+            return self.batch_postings[term]
+        return self.indexer.read_posting_arrays(term)
+
+    def read_posting_blocks(self, term):
+        """Read the posting blocks of a term, from the posting arrays already read for the queries if there."""
+
+        if self.batch_postings is not None and term in self.batch_postings:
+            return self.indexer.read_posting_blocks(term, self.batch_postings[term])
+        return self.indexer.read_posting_blocks(term)
+
+    def search_matrix(self, queries, top=10):
+        """
+        Search a list of queries, scoring them in batches as a product of the doc×term matrix with the query vectors.
+        The scores are the same as the ones of `search` without boost, apart from rounding.
+
+        @param queries: the list of queries
+        @param top: the number of results of each query
+        @return: the results of each query, in the same order
+        """
+        all_terms = [self.indexer.tokenizer.normalize_tokens(query.strip().split()) for query in queries]
+
+        all_results = [None] * len(queries)
+        batch = [i for i, terms in enumerate(all_terms) if terms]
+        for b in range(0, len(batch), self.batch_size):
+            indexes = batch[b:b + self.batch_size]
+            with self.instrumentation.phase("score"):
+                scored = self.matrix.dot([self.query_weights(all_terms[i]) for i in indexes])
+            self.instrumentation.count("queries", len(indexes))
+
+            for i, (rows, scores) in zip(indexes, scored):
+                rows, scores = self.rank_arrays(rows, scores, top)
+                all_results[i] = [(self.matrix.docs[row], score) for row, score in zip(rows, scores.tolist())]
+
+        return all_results
+
+    def array_score(self, terms: List[str], top=None, k1=None, b=None):
+        """
+        Sort and rank the documents of an index with integer document IDs, according to its ranking.
+        The scores are accumulated in an array indexed by the document IDs, and only the IDs
+        of the top documents are mapped to the original document IDs.
+        The BM25 weights of an index with query-time BM25 are calculated from the term frequencies, with `k1` and `b`.
+        """
+        try:
+            for term, weight in self.query_weights(terms).items():
+                if (term_info := self.read_posting_arrays(term)):
+                    idf, doc_ids, weights = term_info
+                    if self.indexer.query_time_bm25:
+                        weights = self.indexer.bm25_weights(idf, doc_ids, weights, k1, b)
+                    np.add.at(self.scores, doc_ids, weights * weight)
+                    self.matched[doc_ids] = True
+
+            doc_ids = np.flatnonzero(self.matched)
+            scores = self.scores[doc_ids]
+        finally:
+            # only the documents scored need to be reset
+            self.scores[self.matched] = 0
+            self.matched[:] = False
+
+        doc_ids, scores = self.rank_arrays(doc_ids, scores, top)
+        return [(self.indexer.doc_ids[str(doc_id)], score) for doc_id, score in zip(doc_ids, scores.tolist())]
+
+    def query_weights(self, terms: List[str]):
+        """Get the weight of each term of the query that is in the index, as used by the ranking."""
+
+        weights = {}
+        terms_in_index = [term for term in set(terms) if term in self.indexer.term_info]
 
-    def tf_idf_score(self, terms: List[str]):
+        if self.indexer.ranking.name == "VSM":
+            cos_norm = 0
+            for term in terms_in_index:
+                cnt = terms.count(term)
+                tf = cnt
+                dc = 1
+
+                if self.indexer.ranking.p2[0] == 'l':
+                    tf = 1 + math.log10(tf)
+
+                if self.indexer.ranking.p2[1] == 't':
+                    dc = float(self.indexer.term_info[term].idf)
+
+                lt = tf * dc
+                cos_norm += lt**2
+                weights[term] = lt * cnt
+
+            if weights and self.indexer.ranking.p2[2] == 'c':
+                cos_norm = 1 / math.sqrt(cos_norm)
+                for term in weights:
+                    weights[term] *= cos_norm
+
+        elif self.indexer.ranking.name == "BM25":
+            for term in terms_in_index:
+                # as in bm25_score, every distinct term of the query counts once
+                weights[term] = 1
+
+        return weights
+
+    @staticmethod
+    def rank_arrays(docs, scores, top=None):
+        """
+        Sort the documents of an array by score, keeping only the `top` documents if provided.
+        The documents with the same score are sorted by their order in the index.
+        """
+        if top is not None and len(docs) > top:
+            # the documents with the top scores, still unsorted, and all the ones with the same score as the last,
+            # so the ones with the same score are selected by their order as well
+            last_score = np.partition(scores, len(scores) - top)[len(scores) - top]
+            selected = np.flatnonzero(scores >= last_score)
+            docs, scores = docs[selected], scores[selected]
+
+        order = np.lexsort((docs, -scores))[:top]
+        return docs[order], scores[order]
+
+    @staticmethod
+    def rank(scores, top=None):
+        """
+        Sort the documents by score, keeping only the `top` documents if provided.
+        The documents with the same score keep the order they were scored.
+        """
+        if top is None:
+            return sorted(scores.items(), key=lambda x: -x[1])
+        # equivalent to sorting and slicing, without sorting every document
+        return heapq.nlargest(top, scores.items(), key=lambda x: x[1])
+
+    def tf_idf_score(self, terms: List[str], top=None):
         """Sort and rank the documents according to VSM"""
 
         scores = {}
         cos_norm = 0
         term_postings = {}
         for term in set(terms):
-            if (term_info := self.indexer.read_posting_lists(term)):
+            if (term_info := self.read_posting_lists(term)):
                 idf, weights, postings = term_info
                 term_postings[term] = postings
                 cnt = terms.count(term)
@@ -163,17 +493,17 @@ class Query:
             for doc in scores:
                 scores[doc] *= cos_norm
 
-        if self.boost_window:    
-            scores = self.boost_query(terms, term_postings, scores)
-        return sorted(scores.items(), key=lambda x: -x[1])
+        if self.boost_window:
+            scores = self.boost(terms, term_postings, scores)
+        return self.rank(scores, top)
 
-    def bm25_score(self, terms: List[str]):
+    def bm25_score(self, terms: List[str], top=None):
         """Sort and rank the documents according to BM25"""
 
         scores = {}
         term_postings = {}
         for term in set(terms):
-            if (term_info := self.indexer.read_posting_lists(term)):
+            if (term_info := self.read_posting_lists(term)):
                 _, weights, postings = term_info
                 term_postings[term] = postings
                 cnt = term.count(term)
@@ -182,10 +512,177 @@ class Query:
                     scores[doc] += float(weights[i]) * cnt
 
         if self.boost_window:
-            scores = self.boost_query(terms, term_postings, scores)
-        return sorted(scores.items(), key=lambda x: -x[1])
+            scores = self.boost(terms, term_postings, scores)
+        return self.rank(scores, top)
+
+    def bm25_max_score(self, terms: List[str], top=10):
+        """
+        Rank the top documents of an index with integer document IDs according to BM25, skipping the documents
+        that cannot enter the top and the blocks of postings without documents left to score, without decoding them.
+        A lower bound of the score of the last top document is taken from the highest weights of the blocks.
+        The terms whose upper bounds add up to less than it are not essential (MaxScore), as the documents with only
+        them cannot enter the top, and neither can the documents of the blocks of the essential terms whose highest
+        weight, added to the upper bounds of the other terms, does not reach it. The documents of the other blocks
+        are the candidates, which are only looked up in the blocks not decoded while their upper bounds reach it.
+        The results are the same as the ones of `array_score`, including the order of documents with the same score.
+        """
+        term_info = self.indexer.term_info
+        if top is None or any(term_info[term].max_weight is None for term in set(terms) if term in term_info):
+            # the upper bounds are not stored in indexes created before them
+            return self.array_score(terms, top)
+
+        # [(PostingBlocks, query weight, upper bound)] in the order array_score adds the weights
+        term_blocks = []
+        for term, weight in self.query_weights(terms).items():
+            if (info := self.read_posting_blocks(term)):
+                term_blocks.append((info[1], weight, (term_info[term].max_weight + WAND_EPSILON) * weight))
+        if not term_blocks:
+            return []
+
+        # the highest weight of a block is the weight of one of its documents, and the weights are not negative,
+        # so the scores of the top documents are at least the top highest weights of the blocks of any term
+        threshold = -math.inf
+        for blocks, weight, _ in term_blocks:
+            if len(blocks) >= top:
+                block_weights = blocks.max_weights * weight
+                threshold = max(threshold, np.partition(block_weights, len(blocks) - top)[len(blocks) - top])
+
+        by_bound = sorted(range(len(term_blocks)), key=lambda i: term_blocks[i][2])
+        optional_bound = 0
+        n_optional = 0
+        while n_optional < len(by_bound) and optional_bound + term_blocks[by_bound[n_optional]][2] < threshold:
+            optional_bound += term_blocks[by_bound[n_optional]][2]
+            n_optional += 1
+
+        total_bound = sum(bound for *_, bound in term_blocks)
+        decoded = [{} for _ in term_blocks]     # {block: (doc_ids, weights)} of each term
+        try:
+            for i in by_bound[n_optional:]:
+                blocks, weight, bound = term_blocks[i]
+                block_bounds = (blocks.max_weights + WAND_EPSILON) * weight + (total_bound - bound)
+                for block in np.flatnonzero(block_bounds >= threshold).tolist():
+                    decoded[i][block] = blocks.decode_block(block)
+                    self.matched[decoded[i][block][0]] = True
+            candidates = np.flatnonzero(self.matched)
+        finally:
+            self.matched[:] = False
+
+        def add_weights(i, contribution, selected, blocks):
+            """Set the weights of term `i` of the selected candidates, which are in the decoded blocks."""
+            if not blocks:
+                return
+            doc_ids = np.concatenate([decoded[i][block][0] for block in blocks])
+            weights = np.concatenate([decoded[i][block][1] for block in blocks])
+            # the weights are looked up in the accumulator of the scores, which is reset after
+            try:
+                self.scores[doc_ids] = weights * term_blocks[i][1]
+                contribution[selected] = self.scores[candidates[selected]]
+            finally:
+                self.scores[doc_ids] = 0
+
+        # the weight of each candidate for each term, 0 where they do not have it, from the blocks decoded
+        contributions = []
+        candidate_blocks = []
+        unknown_bounds = np.zeros(len(candidates))
+        for i, (blocks, weight, _) in enumerate(term_blocks):
+            in_block = np.searchsorted(blocks.last_docs, candidates)
+            is_decoded = np.zeros(len(blocks) + 1, dtype=bool)
+            is_decoded[list(decoded[i])] = True
+            unknown = ~is_decoded[in_block] & (in_block < len(blocks))
+            unknown_bounds[unknown] += (blocks.max_weights[in_block[unknown]] + WAND_EPSILON) * weight
+
+            contributions.append(np.zeros(len(candidates)))
+            add_weights(i, contributions[i], is_decoded[in_block], list(decoded[i]))
+            candidate_blocks.append((in_block, unknown))
+
+        # the weights known are a lower bound of the scores of the candidates
+        partial = sum(contributions)
+        if len(partial) >= top:
+            threshold = max(threshold, np.partition(partial, len(partial) - top)[len(partial) - top])
+        kept = partial + unknown_bounds >= threshold
+
+        for i, (in_block, unknown) in enumerate(candidate_blocks):
+            unknown &= kept
+            selected = np.unique(in_block[unknown]).tolist()
+            for block in selected:
+                decoded[i][block] = term_blocks[i][0].decode_block(block)
+            add_weights(i, contributions[i], unknown, selected)
+
+        # adds the weights in the same order as array_score
+        candidates = candidates[kept]
+        scores = np.zeros(len(candidates))
+        for contribution in contributions:
+            scores += contribution[kept]
+
+        doc_ids, scores = self.rank_arrays(candidates, scores, top)
+        return [(self.indexer.doc_ids[str(doc_id)], score) for doc_id, score in zip(doc_ids, scores.tolist())]
+
+    def boost(self, terms: List[str], term_postings, scores):
+        """Boost the scores of the documents with the query terms close together, as set by the boost mode."""
+
+        with self.instrumentation.phase("boost_query"):
+            if self.boost_mode == "reference":
+                return self.boost_query(terms, term_postings, scores)
+            return self.proximity_boost(terms, term_postings, scores)
+
+    def proximity_boost(self, terms: List[str], term_postings, scores):
+        """
+        Boost the scores of the documents where the query terms appear close together.
+        The sorted positions of the query terms in a document are merged, and a single pass over them finds,
+        for each position, the shortest window ending there with at least two distinct terms that spans
+        less than `boost_window` positions. Each window adds its coverage of the query terms times its density,
+        halved if its terms are not in the order of the query.
+        The time taken is linear in the number of positions, as the windows are bounded by `boost_window`.
+        """
+        query_terms = list(dict.fromkeys(terms))
+        order = {term: i for i, term in enumerate(query_terms)}
+        exponent = 2 if self.indexer.ranking.name == "VSM" else 1
+
+        # only the documents with two or more query terms have windows
+        seen = set()
+        candidates = set()
+        for postings in term_postings.values():
+            candidates |= seen.intersection(postings)
+            seen.update(postings)
+
+        term_postings = [(order[term], postings) for term, postings in term_postings.items()]
+        for doc in candidates:
+            # merges the sorted [(position, term order)] of each query term in the document
+            positions = list(heapq.merge(*([(int(pos), t) for pos in postings[doc]]
+                                           for t, postings in term_postings if doc in postings)))
+            if not positions:
+                # the index is not positional
+                continue
+            counts = [0] * len(query_terms)     # occurrences of each term in the window
+            distinct = 0
+            left = 0
+            boost = 0
+            for right, (pos, t) in enumerate(positions):
+                distinct += counts[t] == 0
+                counts[t] += 1
+
+                # shrinks the window until it is short enough and its first term is not repeated in it
+                while pos - positions[left][0] >= self.boost_window or counts[positions[left][1]] > 1:
+                    first = positions[left][1]
+                    counts[first] -= 1
+                    distinct -= counts[first] == 0
+                    left += 1
+
+                if distinct < 2 or counts[t] > 1:
+                    # a window ending before this position has the same terms
+                    continue
+
+                window = positions[left:right + 1]
+                in_order = all(a[1] <= b[1] for a, b in zip(window, window[1:]))
+                density = distinct / (pos - positions[left][0] + 1)
+                boost += (distinct / len(query_terms) * density * (1 if in_order else 0.5))**exponent
+
+            scores[doc] += scores[doc] * 0.8 * boost / len(positions)
+
+        return scores
 
     def boost_query(self, terms: List[str], term_postings, scores):
+        """Boost the scores with the original sliding windows scored by their edit distance to the query."""
 
         positions = {}
         for doc in scores:
@@ -0,0 +1,330 @@
+# Bruno Bastos 93302
+# Leandro Silva 93446
+
+import asyncio
+import json
+import logging
+import os
+import signal
+import time
+from concurrent.futures import ProcessPoolExecutor
+from urllib.parse import urlsplit, parse_qs
+
+from indexer import Indexer
+from query import Query
+
+
+# the server only accepts connections from the same machine
+HOST = "127.0.0.1"
+
+# maximum size of the request line and of each header
+MAX_LINE_SIZE = 8192
+
+STATUS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+          413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+# query of the search worker processes, set up once by `_init_search_worker`
+_worker_query = None
+
+
+def _init_search_worker(directory, posting_cache_size, query_options):
+    global _worker_query
+    # the server process stops the workers when interrupted
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    indexer = Indexer.load_metadata(directory)
+    if posting_cache_size is not None:
+        indexer.set_posting_cache_size(posting_cache_size)
+    indexer.open_segments()
+    _worker_query = Query(indexer, **query_options)
+
+
+def _worker_stats():
+    """Return the process ID of a worker and the counters of its caches."""
+
+    stats = {}
+    # the index of the query is loaded again when a new generation is written, with a new posting cache
+    if (cache := _worker_query.indexer.posting_cache) is not None:
+        stats["posting_cache"] = cache.stats()
+    if (cache := _worker_query.cache) is not None:
+        stats["result_cache"] = cache.stats()
+    return os.getpid(), stats
+
+
+def _search(query, top, k1=None, b=None):
+    """Search a query in a worker process and return the results, the time it took and the worker stats."""
+
+    start = time.perf_counter()
+    results = _worker_query.search(query, top, k1, b)
+    return results or [], time.perf_counter() - start, _worker_stats()
+
+
+class HTTPError(Exception):
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class SearchServer:
+    """
+    Serves the searches of an index as a JSON HTTP endpoint.
+    The connections are handled by an asyncio event loop, while the queries are scored by a pool
+    of processes, each one with the index loaded and its index files memory mapped.
+
+    Endpoints:
+        GET /search?q=QUERY[&top=N][&k1=K1&b=B]
+        POST /search with a JSON body {"query": QUERY, "top": N, "k1": K1, "b": B}
+        GET /stats
+    """
+
+    def __init__(self, directory, port=8000, workers=1, max_concurrency=8, posting_cache_size=None,
+                 **query_options):
+        """
+        @param directory: the directory of the index
+        @param port: the port of the server, on localhost
+        @param workers: the number of processes that score the queries
+        @param max_concurrency: the maximum number of queries being searched at the same time,
+            the other ones wait for their turn
+        @param posting_cache_size: the memory budget of the posting lists cache of each worker,
+            or None to use the one of the indexer
+        @param query_options: the options of the `Query` of each worker
+        """
+        self.directory = directory
+        self.port = port
+        self.workers = workers
+        self.max_concurrency = max_concurrency
+        self.posting_cache_size = posting_cache_size
+        self.query_options = query_options
+
+        self.pool = None
+        self.semaphore = None
+        # whether the requests can change k1 and b, read from the config of the index
+        self.query_time_bm25 = False
+
+        self.requests = 0
+        self.errors = 0
+        self.in_flight = 0
+        self.searches = 0
+        self.search_time = 0
+        # {process ID: counters of its caches} of every worker, as last reported by it
+        self.worker_stats = {}
+
+    async def serve(self):
+        """Start the workers and serve requests until cancelled."""
+
+        if not os.path.exists(f"{self.directory}.metadata/config.json"):
+            logging.error("Index Directory does not exist. Cannot serve searches.")
+            exit(1)
+
+        # the workers would fail to start with BM25 parameters the index cannot use
+        self.query_time_bm25 = Indexer.read_config(f"{self.directory}.metadata/config.json").query_time_bm25
+        try:
+            Query.check_bm25_parameters(self.query_time_bm25, self.query_options.get("k1"), self.query_options.get("b"))
+        except ValueError as e:
+            logging.error(f"{e}. Cannot serve searches.")
+            exit(1)
+
+        self.semaphore = asyncio.Semaphore(self.max_concurrency)
+        self.pool = ProcessPoolExecutor(self.workers, initializer=_init_search_worker,
+                                        initargs=(self.directory, self.posting_cache_size, self.query_options))
+        loop = asyncio.get_running_loop()
+        loop.add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+        try:
+            # loads the index in every worker before accepting requests
+            start = time.perf_counter()
+            await self.update_worker_stats()
+            logging.info(f"Time taken to start up {self.workers} workers: "
+                         f"{time.perf_counter() - start:.2f} seconds")
+
+            server = await asyncio.start_server(self.handle_connection, HOST, self.port, limit=MAX_LINE_SIZE)
+            logging.info(f"Serving searches on http://{HOST}:{self.port}/search")
+            async with server:
+                await server.serve_forever()
+        except asyncio.CancelledError:
+            pass
+        finally:
+            self.pool.shutdown(cancel_futures=True)
+            logging.info("Server stopped")
+
+    async def search(self, query, top=10, k1=None, b=None):
+        """Search a query in the worker pool, waiting while the concurrency limit is reached."""
+
+        async with self.semaphore:
+            self.in_flight += 1
+            try:
+                loop = asyncio.get_running_loop()
+                results, elapsed, (pid, stats) = await loop.run_in_executor(self.pool, _search, query, top, k1, b)
+            finally:
+                self.in_flight -= 1
+
+        self.worker_stats[pid] = stats
+        self.searches += 1
+        self.search_time += elapsed
+        return {"query": query, "results": [{"doc": doc, "score": score} for doc, score in results],
+                "time": elapsed}
+
+    async def update_worker_stats(self):
+        """
+        Ask the workers for the counters of their caches. The pool gives the tasks to any worker,
+        so the stats of a worker that gets none are the ones returned with its last search.
+        """
+        loop = asyncio.get_running_loop()
+        for pid, stats in await asyncio.gather(*(loop.run_in_executor(self.pool, _worker_stats)
+                                                 for _ in range(self.workers))):
+            self.worker_stats[pid] = stats
+
+    def cache_stats(self, name):
+        """Add up the counters of a cache of every worker, or None if the workers have no such cache."""
+
+        caches = [stats[name] for stats in self.worker_stats.values() if name in stats]
+        if not caches:
+            return None
+        total = {key: sum(cache[key] for cache in caches) for key in caches[0] if key != "hit_ratio"}
+        lookups = total["hits"] + total["misses"]
+        total["hit_ratio"] = total["hits"] / lookups if lookups else 0
+        return total
+
+    async def stats(self):
+        await self.update_worker_stats()
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "searches": self.searches,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "workers": self.workers,
+            "average_search_time": self.search_time / self.searches if self.searches else 0,
+            # size is the estimated bytes of the posting lists cached
+            "posting_cache": self.cache_stats("posting_cache"),
+            # size is the number of results cached, and expirations the ones that outlived the TTL
+            "result_cache": self.cache_stats("result_cache"),
+        }
+
+    async def handle_connection(self, reader, writer):
+        """Answer the requests of a connection until it is closed."""
+
+        try:
+            while (request := await self.read_request(reader)):
+                method, target, headers, body = request
+                self.requests += 1
+
+                try:
+                    status, response = 200, await self.route(method, target, body)
+                except HTTPError as e:
+                    status, response = e.status, {"error": str(e)}
+                except Exception as e:
+                    logging.exception(f"Error answering {method} {target}")
+                    status, response = 500, {"error": str(e)}
+                if status != 200:
+                    self.errors += 1
+
+                keep_alive = headers.get("connection", "").lower() != "close"
+                await self.write_response(writer, status, response, keep_alive)
+                if not keep_alive:
+                    break
+        except HTTPError as e:
+            self.errors += 1
+            await self.write_response(writer, e.status, {"error": str(e)}, False)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def read_request(self, reader):
+        """Read a HTTP request and return its method, target, headers and body, or None if the connection closed."""
+
+        try:
+            line = await reader.readline()
+        except (asyncio.LimitOverrunError, ValueError):
+            raise HTTPError(413, "Request line too long")
+        if not line:
+            return None
+
+        try:
+            method, target, _ = line.decode("latin-1").split(" ", 2)
+        except ValueError:
+            raise HTTPError(400, "Malformed request line")
+
+        headers = {}
+        while True:
+            try:
+                line = await reader.readline()
+            except (asyncio.LimitOverrunError, ValueError):
+                raise HTTPError(413, "Header too long")
+            line = line.decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        try:
+            length = int(headers.get("content-length", 0))
+        except ValueError:
+            raise HTTPError(400, "Invalid Content-Length")
+        if length > MAX_LINE_SIZE:
+            raise HTTPError(413, "Request body too large")
+        body = await reader.readexactly(length) if length else b""
+
+        return method, target, headers, body
+
+    async def route(self, method, target, body):
+        """Answer a request and return the JSON response."""
+
+        url = urlsplit(target)
+        if url.path == "/stats":
+            if method != "GET":
+                raise HTTPError(405, "Use GET")
+            return await self.stats()
+
+        if url.path != "/search":
+            raise HTTPError(404, f"Unknown path {url.path}")
+
+        if method == "GET":
+            params = {name: values[0] for name, values in parse_qs(url.query).items()}
+            query = params.get("q")
+        elif method == "POST":
+            try:
+                params = json.loads(body or b"{}")
+            except json.JSONDecodeError:
+                raise HTTPError(400, "The body is not valid JSON")
+            if not isinstance(params, dict):
+                raise HTTPError(400, "The body must be a JSON object")
+            query = params.get("query")
+        else:
+            raise HTTPError(405, "Use GET or POST")
+
+        if not isinstance(query, str) or not query.strip():
+            raise HTTPError(400, "Missing query")
+
+        try:
+            top = int(params.get("top", 10))
+        except (TypeError, ValueError):
+            raise HTTPError(400, "The number of results, top, must be an integer")
+        if top < 1:
+            raise HTTPError(400, "The number of results, top, must be positive")
+
+        bm25 = {}
+        for name in ("k1", "b"):
+            if params.get(name) is not None:
+                try:
+                    bm25[name] = float(params[name])
+                except (TypeError, ValueError):
+                    raise HTTPError(400, f"The BM25 parameter {name} must be a number")
+
+        try:
+            Query.check_bm25_parameters(self.query_time_bm25, **bm25)
+        except ValueError as e:
+            raise HTTPError(400, str(e))
+
+        return await self.search(query, top, **bm25)
+
+    async def write_response(self, writer, status, response, keep_alive=True):
+        body = json.dumps(response).encode()
+        head = (f"HTTP/1.1 {status} {STATUS[status]}\r\n"
+                "Content-Type: application/json\r\n"
+                f"Content-Length: {len(body)}\r\n"
+                f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+        writer.write(head.encode() + body)
+        await writer.drain()
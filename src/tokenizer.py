@@ -4,6 +4,11 @@
 from nltk.stem import SnowballStemmer
 import os
 import re
+from utils import LRUCache
+
+# runs of the characters kept in a token, every other character splits it
+ALPHANUMERIC = re.compile(r'[a-zA-Z0-9]+')
+
 
 class Review:
     ID = 2
@@ -16,12 +21,14 @@ class Tokenizer:
 
     def __init__(self, case_folding=True, no_numbers=True, stemmer=True, min_length=3,
                  stopwords_file="../data/nltk_en_stopwords.txt", 
-                 contractions_file="../data/en_contractions.txt", **ignore):
+                 contractions_file="../data/en_contractions.txt", cache_size=100_000, engine="default",
+                 **ignore):
 
         self.min_length = min_length
         self.max_length = 123
         self.case_folding = case_folding
         self.no_numbers = no_numbers
+        self.engine = engine
         self.contractions = {}
         self.stopwords = set()
         self.stemmer = None
@@ -38,9 +45,32 @@ class Tokenizer:
         if stemmer:
             self.stemmer = SnowballStemmer("english")
 
-    def normalize_tokens(self, terms):
+        # cache of the terms that result from a token
+        self.cache_size = cache_size
+        self.cache = LRUCache(cache_size) if cache_size else None
+
+    def normalize_tokens(self, tokens):
         """Transform a list of tokens in terms."""
 
+        if self.cache is None:
+            return self.__normalize(tokens)
+
+        terms = []
+        for token in tokens:
+            normalized = self.cache.get(token)
+            if normalized is None:
+                normalized = tuple(self.__normalize([token]))
+                self.cache.put(token, normalized)
+            terms.extend(normalized)
+
+        return terms
+
+    def __normalize(self, terms):
+        """Transform a list of tokens in terms without using the cache."""
+
+        if self.engine == "fast":
+            return self.__normalize_fast(terms)
+
         terms = [re.sub(r'[^a-zA-Z0-9]', ' ', term).split() for term in terms]
         terms = [term for subterms in terms for term in subterms if len(term) <= self.max_length]
 
@@ -61,6 +91,39 @@ class Tokenizer:
 
         return terms
 
+    def __normalize_fast(self, tokens):
+        """
+        Transform a list of tokens in terms with a single pass over the tokens.
+        The terms are the same as the ones of the default engine.
+        """
+        min_length = self.min_length or 0
+        max_length = self.max_length
+        stopwords = self.stopwords
+        contractions = self.contractions
+        no_numbers = self.no_numbers
+        case_folding = self.case_folding
+        stem = self.stemmer.stem if self.stemmer else None
+
+        terms = []
+        for token in tokens:
+            for term in ALPHANUMERIC.findall(token):
+                if not min_length <= len(term) <= max_length or term in stopwords:
+                    continue
+                if term in contractions:
+                    term = contractions[term]
+                    if no_numbers and term.replace(',', '').replace('.', '').isdigit():
+                        continue
+                elif no_numbers and term.isdigit():
+                    # the split already removed any ',' and '.'
+                    continue
+                if case_folding:
+                    term = term.casefold()
+                if stem:
+                    term = stem(term)
+                terms.append(term)
+
+        return terms
+
     def tokenize(self, line):
         """Tokenize a document and return the terms position."""
 
@@ -74,6 +137,6 @@ class Tokenizer:
         # self.update_fields(doc)
         terms = []
         for pos, term in enumerate(self.normalize_tokens(review.split())):
-            terms.append((term, str(pos)))
+            terms.append((term, pos))
         
         return terms, review_id
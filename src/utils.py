@@ -1,8 +1,13 @@
 # Bruno Bastos 93302
 # Leandro Silva 93446
 
+import functools
 import os
+import sys
 import math
+import itertools
+import time
+from collections import OrderedDict
 import numpy as np
 
 def get_directory_size(directory):
@@ -32,7 +37,212 @@ def convert_size(size_bytes):
     return f"{s} {size_name[i]}"
 
 
+def encode_varint(value, out):
+    """Append the variable length encoding of the non-negative integer `value` to the bytearray `out`."""
+    while value >= 0x80:
+        out.append((value & 0x7f) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def decode_varint(data, i=0):
+    """Return the integer encoded in `data` at offset `i` and the offset after it."""
+    value = shift = 0
+    while True:
+        byte = data[i]
+        i += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, i
+        shift += 7
+
+
+def read_varint(f):
+    """Return the integer encoded at the current position of the binary file `f`, or None at its end."""
+    value = shift = 0
+    while (byte := f.read(1)):
+        byte = byte[0]
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value
+        shift += 7
+    return None
+
+
+class LRUCache:
+    """
+    A bounded mapping that evicts the least recently used entries.
+    By default the size of every entry is 1, so `max_size` is the maximum number of entries,
+    otherwise it is the maximum sum of the sizes given by `sizeof`, such as their bytes in memory.
+    If `ttl` is provided, the entries also expire `ttl` seconds after being stored.
+    """
+
+    def __init__(self, max_size, sizeof=None, ttl=None):
+        self.max_size = max_size
+        self.sizeof = sizeof
+        self.ttl = ttl
+        self.entries = OrderedDict()    # {key: (value, size, expiration time)}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, key):
+        return key in self.entries
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0
+
+    def get(self, key, default=None):
+        """Return the value of `key` and mark it as the most recently used."""
+        try:
+            value, size, expiration = self.entries[key]
+        except KeyError:
+            self.misses += 1
+            return default
+
+        if expiration is not None and time.monotonic() >= expiration:
+            del self.entries[key]
+            self.size -= size
+            self.expirations += 1
+            self.misses += 1
+            return default
+
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """Store `value` for `key`, evicting the least recently used entries if full."""
+        size = self.sizeof(value) if self.sizeof else 1
+        if size > self.max_size:
+            # it would evict every entry and still not fit
+            return
+
+        if key in self.entries:
+            self.size -= self.entries[key][1]
+        expiration = time.monotonic() + self.ttl if self.ttl is not None else None
+        self.entries[key] = (value, size, expiration)
+        self.entries.move_to_end(key)
+        self.size += size
+        while self.size > self.max_size:
+            _, (_, evicted_size, _) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.evictions += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    def stats(self):
+        return {
+            "entries": len(self.entries),
+            "size": self.size,
+            "max_size": self.max_size,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "hit_ratio": self.hit_ratio,
+        }
+
+
+def get_object_size(obj, samples=None):
+    """
+    Return an estimate of the bytes in memory of an object and of the objects it contains.
+    Only the builtin containers and NumPy arrays are traversed.
+
+    @param obj: the object
+    @param samples: if provided, the containers with more items are estimated from their first `samples` items
+    """
+    if isinstance(obj, np.ndarray):
+        # the size of an array includes its data, unless it is a view of another array
+        return sys.getsizeof(obj) + (0 if obj.flags.owndata else obj.nbytes)
+
+    size = sys.getsizeof(obj)
+    if isinstance(obj, (dict, list, tuple, set)) and obj:
+        items = obj.items() if isinstance(obj, dict) else obj
+        n_items = len(obj) if not samples else min(len(obj), samples)
+
+        items_size = 0
+        for item in itertools.islice(items, n_items):
+            if isinstance(obj, dict):
+                items_size += get_object_size(item[0], samples) + get_object_size(item[1], samples)
+            else:
+                items_size += get_object_size(item, samples)
+        size += items_size * len(obj) // n_items
+    return size
+
+
 def levenshtein(seq1, seq2):
+    """
+    Return the minimal number of deletions, insertions, or
+    substitutions that are required to transform `seq1` into `seq2`.
+    The distances are memoized, as the same query is compared with many windows.
+
+    @param seq1: a sequence of hashable items, such as terms
+    @param seq2: a sequence of hashable items
+    """
+    return _levenshtein_memoized(tuple(seq1), tuple(seq2))
+
+
+@functools.lru_cache(maxsize=100_000)
+def _levenshtein_memoized(seq1, seq2):
+    return levenshtein_bit_parallel(seq1, seq2)
+
+
+# the memoized distances are cleared and inspected as the ones of a lru_cache function
+levenshtein.cache_clear = _levenshtein_memoized.cache_clear
+levenshtein.cache_info = _levenshtein_memoized.cache_info
+
+
+def levenshtein_bit_parallel(seq1, seq2):
+    """
+    Return the edit distance between `seq1` and `seq2` with the bit-parallel algorithm of Myers, as
+    formulated by Hyyrö. Each column of the DP matrix is kept as bit vectors of the vertical deltas,
+    with a bit for each item of `seq1`, so each item of `seq2` is processed in a few integer operations.
+    Python integers have arbitrary precision, so `seq1` can have any length.
+    """
+    m = len(seq1)
+    if not m:
+        return len(seq2)
+
+    # bit vectors of the positions of each item in seq1
+    peq = {}
+    for i, item in enumerate(seq1):
+        peq[item] = peq.get(item, 0) | 1 << i
+
+    mask = (1 << m) - 1
+    last = 1 << (m - 1)
+    pv, mv = mask, 0        # positive and negative vertical deltas
+    distance = m
+    for item in seq2:
+        eq = peq.get(item, 0)
+        xv = eq | mv
+        xh = (((eq & pv) + pv) ^ pv) | eq
+        ph = mv | ~(xh | pv)    # positive and negative horizontal deltas
+        mh = pv & xh
+
+        if ph & last:
+            distance += 1
+        elif mh & last:
+            distance -= 1
+
+        ph = ph << 1 | 1
+        mh <<= 1
+        pv = (mh | ~(xv | ph)) & mask
+        mv = ph & xv
+
+    return distance
+
+
+def levenshtein_dp(seq1, seq2):
     """ Return the minimal number of deletions, insertions, or
     substitutions that are required to transform `seq1` into `seq2`.
 
@@ -0,0 +1,45 @@
+# Bruno Bastos 93302
+# Leandro Silva 93446
+
+import os
+import random
+import sys
+import pytest
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+MAIN = os.path.join(SRC, "main.py")
+
+# the modules of src import each other by name, as when main.py is run from src
+sys.path.insert(0, SRC)
+
+
+HEADER = ("marketplace\tcustomer_id\treview_id\tproduct_id\tproduct_parent\tproduct_title\tproduct_category\t"
+          "star_rating\thelpful_votes\ttotal_votes\tvine\tverified_purchase\treview_headline\treview_body\t"
+          "review_date\n")
+
+
+def write_corpus(filename, n_docs=600, n_words=300, seed=93302, first_doc=0):
+    """
+    Write a dataset of reviews with words drawn from a Zipf-like distribution, so the most frequent terms
+    have postings in more than one block and the rarest ones only in a few documents.
+    """
+    rng = random.Random(seed)
+    words = [f"w{chr(97 + i % 26)}{chr(97 + i // 26 % 26)}{chr(97 + i // 676)}" for i in range(n_words)]
+    weights = [1 / (rank + 1) for rank in range(n_words)]
+
+    with open(filename, "w") as f:
+        f.write(HEADER)
+        for doc in range(first_doc, first_doc + n_docs):
+            title = " ".join(rng.choices(words, weights, k=3))
+            headline = " ".join(rng.choices(words, weights, k=4))
+            body = " ".join(rng.choices(words, weights, k=rng.randint(5, 60)))
+            f.write(f"US\t1\tR{doc:06d}X\tP\t1\t{title}\tMusic\t5\t0\t0\tN\tY\t{headline}\t{body}\t2015-08-31\n")
+
+    return words
+
+
+@pytest.fixture(scope="session")
+def corpus(tmp_path_factory):
+    """A small dataset of reviews and its words, ordered from the most to the least frequent."""
+    filename = str(tmp_path_factory.mktemp("corpus") / "reviews.tsv")
+    return filename, write_corpus(filename)
@@ -0,0 +1,49 @@
+# Bruno Bastos 93302
+# Leandro Silva 93446
+
+import json
+import subprocess
+import sys
+import pytest
+from conftest import MAIN
+
+
+def run_main(cwd, *args):
+    """Run main.py in the directory, where the searches of a file write their results."""
+    subprocess.run([sys.executable, MAIN, *args], cwd=cwd, check=True, capture_output=True)
+
+
+def search_file(directory, queries, *args):
+    run_main(directory, "search", f"{directory}/index/", "-q", queries, *args)
+    with open(f"{directory}/results.txt") as f:
+        return f.read()
+
+
+@pytest.fixture(scope="module")
+def index_dir(corpus, tmp_path_factory):
+    """A binary BM25 index created from the command line, with blocks of postings, and a file of queries."""
+    filename, words = corpus
+    directory = tmp_path_factory.mktemp("cli")
+    run_main(directory, "index", filename, "--merge-dir", f"{directory}/index/", "--index-format", "binary")
+
+    queries = f"{directory}/queries.txt"
+    with open(queries, "w") as f:
+        for i in range(60):
+            # frequent and rare words, so some queries have terms that can be skipped
+            f.write(" ".join(words[(i * 7 + j * 31) % len(words)] for j in range(1 + i % 5)) + "\n")
+
+    return str(directory), queries
+
+
+def test_index_ranking(index_dir):
+    directory, _ = index_dir
+    with open(f"{directory}/index/.metadata/config.json") as f:
+        assert json.load(f)["ranking"]["name"] == "BM25"
+
+
+def test_wand_matches_exhaustive(index_dir):
+    directory, queries = index_dir
+    exhaustive = search_file(directory, queries)
+    assert exhaustive.count("\nR") > 0
+    assert search_file(directory, queries, "--wand") == exhaustive
+    assert search_file(directory, queries, "--wand", "--posting-cache-size", "0") == exhaustive
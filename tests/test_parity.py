@@ -0,0 +1,133 @@
+# Bruno Bastos 93302
+# Leandro Silva 93446
+
+import os
+import random
+import pytest
+from conftest import write_corpus
+from indexer import Indexer
+from query import Query, BM25, VSM
+from tokenizer import Tokenizer
+from utils import levenshtein, levenshtein_bit_parallel, levenshtein_dp
+
+
+def create_index(filename, directory, ranking=None, **options):
+    """Index a dataset in a directory with small blocks and index files, and load it for searching."""
+    options = {"block_threshold": 100, "merge_threshold": 2000, "file_location_step": 1, **options}
+    indexer = Indexer(Tokenizer(stemmer=False), ranking=ranking or BM25(), merge_dir=directory, **options)
+    indexer.index_file(filename)
+    return Indexer.load_metadata(directory)
+
+
+def read_files(directory):
+    """The contents of the files of an index directory, except its config."""
+    files = {}
+    for path, _, names in os.walk(directory):
+        for name in names:
+            if name != "config.json":
+                with open(os.path.join(path, name), "rb") as f:
+                    files[os.path.relpath(os.path.join(path, name), directory)] = f.read()
+    return files
+
+
+def all_scores(query, terms):
+    """The score of every document with a query term."""
+    return dict(query.search(" ".join(terms), top=1_000_000) or [])
+
+
+@pytest.fixture(scope="module")
+def queries(corpus):
+    _, words = corpus
+    rng = random.Random(93446)
+    # frequent terms, with postings in more than one block, and rare ones
+    return [rng.sample(words[:20] if i % 2 else words, 1 + i % 5) for i in range(40)]
+
+
+@pytest.mark.parametrize("options", [
+    {"ranking": BM25()},
+    {"ranking": VSM(), "positional": True, "save_zip": True},
+    {"ranking": BM25(), "index_format": "binary", "positional": True},
+    {"ranking": BM25(), "query_time_bm25": True, "save_zip": True},
+], ids=["bm25-text", "vsm-text-positional-zip", "bm25-binary-positional", "bm25-query-time-zip"])
+def test_parallel_index_matches_serial(corpus, tmp_path, options):
+    filename, _ = corpus
+    create_index(filename, f"{tmp_path}/serial/", **options)
+    create_index(filename, f"{tmp_path}/parallel/", workers=3, **options)
+
+    serial = read_files(f"{tmp_path}/serial/")
+    assert len([name for name in serial if not name.startswith(".")]) > 1
+    assert read_files(f"{tmp_path}/parallel/") == serial
+
+
+def test_binary_index_matches_text(corpus, tmp_path, queries):
+    filename, _ = corpus
+    text = Query(create_index(filename, f"{tmp_path}/text/"))
+    binary = Query(create_index(filename, f"{tmp_path}/binary/", index_format="binary"))
+
+    for terms in queries:
+        expected = all_scores(text, terms)
+        # the text index rounds the weights to 6 decimals and the binary one stores them as 4 byte floats
+        assert all_scores(binary, terms) == pytest.approx(expected, abs=1e-5)
+
+
+@pytest.mark.parametrize("options", [
+    {"index_format": "binary", "posting_block_size": 8},
+    {"index_format": "binary", "positional": True, "save_zip": True},
+    {"int_doc_ids": True},
+], ids=["binary-small-blocks", "binary-positional-zip", "text"])
+@pytest.mark.parametrize("posting_cache_size", [0, 64 * 1024**2])
+def test_pruned_top_k_matches_exhaustive(corpus, tmp_path, queries, options, posting_cache_size):
+    filename, _ = corpus
+    indexer = create_index(filename, f"{tmp_path}/index/", **options)
+    indexer.set_posting_cache_size(posting_cache_size)
+    exhaustive, pruned = Query(indexer), Query(indexer, dynamic_pruning=True)
+
+    for terms in queries:
+        for top in (1, 10, 50):
+            assert pruned.search(" ".join(terms), top) == exhaustive.search(" ".join(terms), top)
+
+
+def test_query_time_bm25_matches_weights(corpus, tmp_path, queries):
+    filename, _ = corpus
+    weights = Query(create_index(filename, f"{tmp_path}/weights/", BM25(1.5, 0.75), int_doc_ids=True))
+    query_time = Query(create_index(filename, f"{tmp_path}/query-time/", BM25(1.2, 1), query_time_bm25=True),
+                       k1=1.5, b=0.75)
+
+    for terms in queries:
+        assert all_scores(query_time, terms) == pytest.approx(all_scores(weights, terms), abs=1e-5)
+
+
+def test_appended_index_matches_full(corpus, tmp_path, queries):
+    filename, _ = corpus
+    parts = [str(tmp_path / f"part{i}.tsv") for i in range(4)]
+    for i, part in enumerate(parts):
+        write_corpus(part, n_docs=150, seed=i, first_doc=150 * i)
+    with open(str(tmp_path / "full.tsv"), "w") as full:
+        for i, part in enumerate(parts):
+            with open(part) as f:
+                full.writelines(f.readlines()[bool(i):])
+
+    expected = Query(create_index(str(tmp_path / "full.tsv"), f"{tmp_path}/full/", query_time_bm25=True))
+    create_index(parts[0], f"{tmp_path}/appended/", query_time_bm25=True, merge_factor=2)
+    for part in parts[1:]:
+        Indexer.load_metadata(f"{tmp_path}/appended/").append_file(part)
+    appended = Indexer.load_metadata(f"{tmp_path}/appended/")
+    # the tiered merge keeps fewer generations than the ones appended
+    assert 1 <= len(appended.generations) < 3
+
+    for terms in queries:
+        assert all_scores(Query(appended), terms) == pytest.approx(all_scores(expected, terms), abs=1e-5)
+
+
+def test_levenshtein_bit_parallel_matches_dp():
+    rng = random.Random(93302)
+    pairs = [((), ()), ((), "abc"), ("abc", ()), ("kitten", "sitting"), ("flaw", "lawn")]
+    for _ in range(300):
+        # small alphabets repeat the items, long sequences use more than one machine word of bits
+        alphabet = "ab" if rng.random() < 0.5 else "abcdefgh"
+        pairs.append((rng.choices(alphabet, k=rng.randint(0, 80)), rng.choices(alphabet, k=rng.randint(0, 80))))
+
+    for seq1, seq2 in pairs:
+        expected = levenshtein_dp(seq1, seq2)
+        assert levenshtein_bit_parallel(seq1, seq2) == expected
+        assert levenshtein(seq1, seq2) == expected
@@ -0,0 +1,47 @@
+# Bruno Bastos 93302
+# Leandro Silva 93446
+
+import math
+import pytest
+from conftest import write_corpus
+from indexer import Indexer
+from query import Query, BM25
+from tokenizer import Tokenizer
+
+
+@pytest.mark.parametrize("k1, b", [(1.5, None), (None, 0.5), (0, 0), (2, 1)])
+def test_bm25_parameters_valid(k1, b):
+    Query.check_bm25_parameters(True, k1, b)
+
+
+@pytest.mark.parametrize("k1, b", [(-1, None), (None, -0.1), (None, 1.5),
+                                   (math.nan, None), (math.inf, None), (-math.inf, None),
+                                   (None, math.nan), (None, math.inf), (1.2, math.nan)])
+def test_bm25_parameters_invalid(k1, b):
+    with pytest.raises(ValueError):
+        Query.check_bm25_parameters(True, k1, b)
+
+
+def test_bm25_parameters_precomputed_weights():
+    Query.check_bm25_parameters(False)
+    with pytest.raises(ValueError):
+        Query.check_bm25_parameters(False, 1.2, 0.75)
+
+
+def test_results_cache_reloads_new_generation(corpus, tmp_path):
+    filename, words = corpus
+    directory = f"{tmp_path}/index/"
+    Indexer(Tokenizer(stemmer=False), ranking=BM25(), merge_dir=directory, query_time_bm25=True).index_file(filename)
+
+    query = Query(Indexer.load_metadata(directory), cache_size=100)
+    before = query.search(words[0])
+    assert query.search(words[0]) == before and query.cache.hits == 1
+
+    # another process appends documents to the index directory
+    appended = str(tmp_path / "appended.tsv")
+    write_corpus(appended, n_docs=50, seed=93446, first_doc=600)
+    Indexer.load_metadata(directory).append_file(appended)
+
+    after = query.search(words[0])
+    assert query.indexer.generation == 2 and query.indexer.num_docs == 650
+    assert after != before and query.cache.hits == 1
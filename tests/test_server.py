@@ -0,0 +1,75 @@
+# Bruno Bastos 93302
+# Leandro Silva 93446
+
+import json
+import socket
+import subprocess
+import sys
+import time
+import urllib.request
+import pytest
+from conftest import MAIN
+from indexer import Indexer
+from query import BM25
+from tokenizer import Tokenizer
+
+
+def get(url):
+    with urllib.request.urlopen(url, timeout=10) as response:
+        return json.load(response)
+
+
+@pytest.fixture(scope="module")
+def server(corpus, tmp_path_factory):
+    """The URL of a server with two workers searching a binary BM25 index."""
+    filename, words = corpus
+    directory = f"{tmp_path_factory.mktemp('server')}/index/"
+    Indexer(Tokenizer(stemmer=False), ranking=BM25(), merge_dir=directory, index_format="binary").index_file(filename)
+
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    process = subprocess.Popen([sys.executable, MAIN, "serve", directory, "--port", str(port), "--workers", "2"],
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        for _ in range(300):
+            try:
+                get(f"{url}/stats")
+                break
+            except OSError:
+                time.sleep(0.1)
+        yield url, words
+    finally:
+        process.terminate()
+        process.wait(10)
+
+
+def test_stats_posting_cache(server):
+    url, words = server
+    # different queries with the same terms, so they are not answered by the results cache
+    queries = [f"{words[i]}+{words[i + 1]}" for i in range(10)] + words[:10]
+    for query in queries:
+        assert get(f"{url}/search?q={query}")["results"]
+
+    stats = get(f"{url}/stats")
+    assert stats["searches"] == 20
+    cache = stats["posting_cache"]
+    # every worker reads each of the 11 terms at most once
+    assert 11 <= cache["misses"] <= 22 and cache["hits"] >= 30 - cache["misses"]
+    assert cache["entries"] == cache["misses"] and cache["size"] > 0 and cache["evictions"] == 0
+    assert cache["hit_ratio"] == cache["hits"] / (cache["hits"] + cache["misses"])
+
+
+def test_stats_result_cache(server):
+    url, words = server
+    before = get(f"{url}/stats")["result_cache"]
+    query = f"{words[20]}+{words[21]}+{words[22]}"
+    for _ in range(6):
+        get(f"{url}/search?q={query}")
+
+    cache = get(f"{url}/stats")["result_cache"]
+    # the query is searched once by each worker that gets it
+    assert 1 <= cache["misses"] - before["misses"] <= 2
+    assert cache["hits"] - before["hits"] == 6 - (cache["misses"] - before["misses"])
+    assert cache["max_size"] == 2 * 1000 and cache["expirations"] == 0